@@ -0,0 +1,206 @@
+"""Офлайн-замеры для Tetris HA: python3 bench.py <сценарий>."""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import timeit
+
+from aiohttp.test_utils import make_mocked_request
+
+import main
+
+
+def legacy_build_command_from_pixels(pixels):
+    """Прежний кодировщик через hex-строки, оставлен для сравнения."""
+    if not pixels:
+        return []
+    commands = []
+    i = 0
+    while i < len(pixels):
+        chunk = pixels[i:i+10]
+        body = ""
+        for row, col, color in chunk:
+            body += f"{row:02x}{col:02x}{''.join(f'{c:02x}' for c in color)}"
+        for _ in range(10 - len(chunk)):
+            body += "ffffffffff"
+        commands.append(bytearray.fromhex("7e0764" + body + "ef"))
+        i += 10
+    return commands
+
+
+def random_pixels(count, seed=0):
+    rng = random.Random(seed)
+    return [
+        (rng.randint(1, main.COLS), rng.randint(1, main.ROWS), rng.choice(main.COLOR_PALETTE))
+        for _ in range(count)
+    ]
+
+
+def bench_encoder(args):
+    results = []
+    for count in args.pixels:
+        pixels = random_pixels(count)
+        legacy = legacy_build_command_from_pixels(pixels)
+        current = main.build_command_from_pixels(pixels)
+        assert [bytes(c) for c in legacy] == [bytes(c) for c in current], "кодировщики расходятся"
+        row = {'pixels': count, 'packets': len(current)}
+        for name, fn in (('legacy', legacy_build_command_from_pixels),
+                         ('build_command_from_pixels', main.build_command_from_pixels),
+                         ('encode_pixel_packets', main.encode_pixel_packets)):
+            runs = timeit.repeat(lambda: fn(pixels), number=args.number, repeat=5)
+            row[f'{name}_us'] = min(runs) / args.number * 1e6
+        row['speedup'] = row['legacy_us'] / row['build_command_from_pixels_us']
+        results.append(row)
+    return {'benchmark': 'encoder', 'results': results}
+
+
+class FakeBleakClient:
+    """Stand-in for BleakClient: configurable write latency, jitter, failed writes and disconnects."""
+
+    latency = 0.005
+    jitter = 0.0
+    drop_rate = 0.0
+    disconnect_every = 0  # разрыв после каждых N записей, 0 — без разрывов
+    rng = random.Random(0)
+    stats = {'writes': 0, 'pixel_packets': 0, 'bytes': 0, 'dropped': 0, 'disconnects': 0, 'connects': 0}
+
+    def __init__(self, address, disconnected_callback=None, **kwargs):
+        self.address = address
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+
+    async def connect(self, timeout=None):
+        await asyncio.sleep(self.latency)
+        self.is_connected = True
+        self.stats['connects'] += 1
+
+    async def disconnect(self):
+        self._drop_link()
+
+    def _drop_link(self):
+        if self.is_connected:
+            self.is_connected = False
+            if self.disconnected_callback is not None:
+                self.disconnected_callback(self)
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        if not self.is_connected:
+            raise RuntimeError("not connected")
+        delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+        await asyncio.sleep(max(0.0, delay))
+        if self.rng.random() < self.drop_rate:
+            self.stats['dropped'] += 1
+            raise RuntimeError("write dropped")
+        stats = self.stats
+        stats['writes'] += 1
+        stats['bytes'] += len(data)
+        if bytes(data[:3]) == main.PACKET_HEADER:
+            stats['pixel_packets'] += 1
+        if self.disconnect_every and stats['writes'] % self.disconnect_every == 0:
+            stats['disconnects'] += 1
+            self._drop_link()
+
+
+async def run_session(fps, duration, rows, cols, devices=1):
+    """One Тетрис session through handle_mode against a fresh BLEPool of fake rows x cols curtains."""
+    FakeBleakClient.stats = dict.fromkeys(FakeBleakClient.stats, 0)
+    ble_pool = main.BLEPool()
+    # Размер только в конфигурации шторы, как в настройках дополнения: ROWS и TARGET_HEIGHT модуля не трогаем
+    app = main.make_app(ble_pool, [main.PanelConfig(f"00:00:00:00:00:{i:02X}", rows, cols, main.GAMES_PER_PANEL)
+                                   for i in range(devices)])
+
+    async def command(cmd):
+        response = await main.handle_mode(make_mocked_request('GET', f'/mode?cmd={cmd}', app=app))
+        if response.status != 200:
+            raise RuntimeError(f"{cmd}: {response.text}")
+
+    await command(f'FPS:{fps}')
+    main.frame_scheduler = None
+    await command('Тетрис')
+    while main.frame_scheduler is None:
+        await asyncio.sleep(0)
+    packets_before = FakeBleakClient.stats['pixel_packets']
+    blocks_before = sys.getallocatedblocks()
+    cpu_before, wall_before = time.process_time(), time.perf_counter()
+    frames_before = main.frame_scheduler.frames
+
+    await asyncio.sleep(duration)
+
+    cpu = time.process_time() - cpu_before
+    wall = time.perf_counter() - wall_before
+    blocks_net = sys.getallocatedblocks() - blocks_before
+    frames = main.frame_scheduler.frames - frames_before
+    frame_stats = main.frame_scheduler.stats()
+    await command('Стоп')
+    await ble_pool.stop()
+
+    stats = FakeBleakClient.stats
+    return {
+        'devices': devices,
+        'fps_target': fps,
+        'fps_achieved': frames / wall,
+        'frames': frames,
+        'frame_ms_p50': frame_stats['frame_ms_p50'],
+        'frame_ms_p99': frame_stats['frame_ms_p99'],
+        'deadline_misses': frame_stats['misses'],
+        'packets_per_sec': (stats['pixel_packets'] - packets_before) / wall,
+        'cpu_ms_per_frame': cpu / frames * 1000 if frames else None,
+        # Прирост занятых блоков памяти интерпретатора за кадр: выделения минус освобождения, любые объекты
+        'net_allocated_blocks_per_frame': blocks_net / frames if frames else None,
+        'ble': dict(stats),
+    }
+
+
+def bench_e2e(args):
+    FakeBleakClient.latency = args.latency
+    FakeBleakClient.jitter = args.jitter
+    FakeBleakClient.drop_rate = args.drop
+    FakeBleakClient.disconnect_every = args.disconnect_every
+    FakeBleakClient.rng = random.Random(args.seed)
+    main.BleakClient = FakeBleakClient
+    main.print = lambda *a, **k: None
+
+    results = []
+    for board in args.boards:
+        rows, cols = map(int, board.lower().split('x'))
+        for fps in args.fps:
+            row = asyncio.run(run_session(fps, args.duration, rows, cols, args.devices))
+            row['board'] = board
+            results.append(row)
+    return {
+        'benchmark': 'e2e',
+        'link': {'latency': args.latency, 'jitter': args.jitter, 'drop_rate': args.drop,
+                 'disconnect_every': args.disconnect_every},
+        'results': results,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest='scenario', required=True)
+
+    enc = sub.add_parser('encoder', help='кодирование пикселей в BLE-пакеты')
+    enc.add_argument('--pixels', type=int, nargs='+', default=[1, 10, 40, 360])
+    enc.add_argument('--number', type=int, default=2000)
+    enc.set_defaults(func=bench_encoder)
+
+    e2e = sub.add_parser('e2e', help='handle_mode → цикл игры → send_commands на имитации BLE')
+    e2e.add_argument('--fps', type=float, nargs='+', default=[3, 10, 30])
+    e2e.add_argument('--boards', nargs='+', default=['18x20', '36x40'], help='строки x колонки')
+    e2e.add_argument('--duration', type=float, default=5.0, help='секунд на прогон')
+    e2e.add_argument('--latency', type=float, default=0.005, help='с на запись')
+    e2e.add_argument('--jitter', type=float, default=0.002)
+    e2e.add_argument('--drop', type=float, default=0.0, help='доля неудачных записей')
+    e2e.add_argument('--disconnect-every', type=int, default=0, help='разрыв после N записей')
+    e2e.add_argument('--devices', type=int, default=1, help='штор с одинаковой панелью')
+    e2e.add_argument('--seed', type=int, default=0)
+    e2e.set_defaults(func=bench_e2e)
+
+    args = parser.parse_args()
+    print(json.dumps(args.func(args), indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main_cli()
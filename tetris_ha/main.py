@@ -1,43 +1,280 @@
 import asyncio
+import json
+import mmap
+import os
 from aiohttp import web
 from bleak import BleakClient
 from bleak import BleakScanner
 import random
 import copy
 import signal
+import struct
+import time
+import multiprocessing
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque, namedtuple
+from itertools import islice
+from operator import itemgetter
+
+try:
+    import numpy as np
+except ImportError:  # без NumPy работает чисто питоновская оценка
+    np = None
+
+# --- Метрики в формате Prometheus
+METRICS = []
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 5, 10, 20, 50, 100, 200, 400)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=None):
+        self.name, self.help, self.labels = name, help, labels
+        self.value = 0
+        METRICS.append(self)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class CallbackMetric:
+    """Gauge or counter whose value is read from a callback at scrape time."""
+
+    def __init__(self, name, help, read, kind="gauge", labels=None):
+        self.name, self.help, self.labels = name, help, labels
+        self.kind = kind
+        self.read = read
+        METRICS.append(self)
+
+    def samples(self):
+        yield self.name, self.labels, self.read()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=SECONDS_BUCKETS, labels=None):
+        self.name, self.help, self.labels = name, help, labels
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        METRICS.append(self)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        labels = self.labels or {}
+        total = 0
+        for bound, n in zip(self.bounds + (float('inf'),), self.counts):
+            total += n
+            le = "+Inf" if bound == float('inf') else f"{bound:g}"
+            yield self.name + "_bucket", {**labels, 'le': le}, total
+        yield self.name + "_sum", self.labels, self.sum
+        yield self.name + "_count", self.labels, self.count
+
+
+def render_metrics():
+    lines, described = [], set()
+    for metric in METRICS:
+        if metric.name not in described:
+            described.add(metric.name)
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+FRAME_COMPUTE_SECONDS = Histogram("tetris_frame_compute_seconds", "Time spent computing one frame")
+FRAME_PIXELS = Histogram("tetris_frame_pixels", "Changed pixels per frame", COUNT_BUCKETS)
+FRAME_MISSES = Counter("tetris_frame_deadline_misses_total", "Frames that finished after their deadline")
+AI_SEARCH_SECONDS = {
+    kind: Histogram("tetris_ai_search_seconds", "Placement search time", labels={'kind': kind})
+    for kind in ('update', 'spawn', 'lookahead')
+}
+FLUSH_FILLS = Counter("tetris_flush_fills_total", "Flushes sent as a fill plus differing pixels")
+FLUSH_PACKETS = Histogram("tetris_flush_packets", "BLE packets per flushed frame", COUNT_BUCKETS)
+FLUSH_SUPERSEDED = Counter("tetris_flush_superseded_total", "Pending pixels replaced by a newer colour before being sent")
+BLE_WRITE_SECONDS = Histogram("tetris_ble_write_seconds", "Latency of one GATT write")
+BLE_WRITE_ERRORS = Counter("tetris_ble_write_errors_total", "Failed write batches")
+BLE_RETRIES = Counter("tetris_ble_retries_total", "send_commands retries")
+BLE_RECONNECTS = Counter("tetris_ble_reconnects_total", "Successful (re)connections")
+BLE_CONNECT_FAILURES = Counter("tetris_ble_connect_failures_total", "Failed connection attempts")
+BLE_LOCK_WAIT_SECONDS = Histogram("tetris_ble_lock_wait_seconds", "Wait time for BLEManager.lock")
+WS_FRAMES = {
+    kind: Counter("tetris_ws_frames_total", "Frames received on /ws by kind", {'kind': kind})
+    for kind in ('full', 'delta', 'invalid')
+}
+SPECULATION_RESULTS = {
+    outcome: Counter("tetris_speculation_total", "Speculative next-piece searches by outcome", {'outcome': outcome})
+    for outcome in ('used', 'discarded', 'late')
+}
+LOOP_LAG_SECONDS = Histogram("tetris_event_loop_lag_seconds", "Event loop scheduling lag")
+LOOP_LAG_INTERVAL = 0.25
+
+
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
 
 class BLEManager:
-    def __init__(self, device_address):
+    """Owns one long-lived connection: reconnects in the background and serializes writes through a queue."""
+
+    def __init__(self, device_address, queue_size=None):
         self.device_address = device_address
         self.client = None
         self.lock = asyncio.Lock()
+        self.queue = asyncio.Queue(maxsize=queue_size or WRITE_QUEUE_SIZE)
+        self.connected = asyncio.Event()
+        self.wanted = asyncio.Event()
+        self.last_successful_write = 0.0
+        self.write_failures = 0  # неудачных пачек подряд
+        self.tasks = []
 
-    async def get_client(self):
+    def start(self):
+        if not self.tasks:
+            self.tasks = [
+                asyncio.create_task(self._connection_owner()),
+                asyncio.create_task(self._writer()),
+                asyncio.create_task(self._keepalive()),
+            ]
+
+    async def stop(self):
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self.disconnect()
+
+    async def get_client(self, timeout=None):
+        if self.connected.is_set() and self.client is not None and self.client.is_connected:
+            return self.client
+        self.start()
+        self.connected.clear()
+        self.wanted.set()
+        async with asyncio.timeout(timeout or CONNECT_WAIT):
+            await self.connected.wait()
+        return self.client
+
+    async def submit(self, commands):
+        """Queue packets for the writer, waiting while the queue is full; returns a future for the result."""
+        self.start()
+        done = asyncio.get_running_loop().create_future()
+        await self.queue.put((commands, done))
+        return done
+
+    def _on_disconnect(self, client):
+        if client is self.client:
+            print(f"⚠️ Соединение с {self.device_address} потеряно")
+            self._connection_lost()
+
+    def _connection_lost(self):
+        self.connected.clear()
+        self.wanted.set()
+
+    async def _connect(self):
+        waited = time.perf_counter()
         async with self.lock:
-            if self.client is not None and self.client.is_connected:
-                try:
-                    await self.client.write_gatt_char(CHAR_UUID, bytearray([0x00]), response=False)
-                    return self.client
-                except Exception as e:
-                    print(f"⚠️ Проверка подключения не удалась: {e}")
+            BLE_LOCK_WAIT_SECONDS.observe(time.perf_counter() - waited)
             if self.client is not None:
                 try:
                     await self.client.disconnect()
                 except:
                     pass
-            self.client = BleakClient(self.device_address)
+            self.client = BleakClient(self.device_address, disconnected_callback=self._on_disconnect)
             try:
                 await self.client.connect(timeout=15.0)
                 await asyncio.sleep(1.0)
                 print(f"✅ Новый клиент подключён к {self.device_address}")
-                return self.client
-            except Exception as e:
-                print(f"❌ Не удалось подключиться к {self.device_address}: {e}")
+            except Exception:
                 self.client = None
                 raise
+        self.connected.set()
+
+    async def _connection_owner(self):
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            await self.wanted.wait()
+            if self.connected.is_set() and self.client is not None and self.client.is_connected:
+                self.wanted.clear()
+                continue
+            try:
+                await self._connect()
+                self.wanted.clear()
+                BLE_RECONNECTS.inc()
+                delay = RECONNECT_MIN_DELAY
+            except Exception as e:
+                BLE_CONNECT_FAILURES.inc()
+                print(f"❌ Не удалось подключиться к {self.device_address}: {e}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            commands, done = await self.queue.get()
+            client = None
+            try:
+                if done.done():
+                    continue
+                client = await self.get_client()
+                for cmd in commands:
+                    started = time.perf_counter()
+                    async with asyncio.timeout(5.0):
+                        await client.write_gatt_char(CHAR_UUID, cmd, response=False)
+                    BLE_WRITE_SECONDS.observe(time.perf_counter() - started)
+                    self.last_successful_write = loop.time()
+                self.write_failures = 0
+                if not done.done():  # ожидавший мог быть отменён, пока шла запись
+                    done.set_result(len(commands))
+            except Exception as e:
+                BLE_WRITE_ERRORS.inc()
+                self.write_failures += 1
+                # Одиночный сбой (таймаут, потерянная запись) проваливает только пачку
+                if client is None or not client.is_connected or self.write_failures >= MAX_WRITE_FAILURES:
+                    self.write_failures = 0
+                    self._connection_lost()
+                if not done.done():
+                    done.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def _keepalive(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            if not self.connected.is_set() or not self.queue.empty():
+                continue
+            if loop.time() - self.last_successful_write >= KEEPALIVE_INTERVAL:
+                done = await self.submit([KEEPALIVE_PACKET])
+                # Ошибку проверки разбирает писатель, здесь результат не нужен
+                done.add_done_callback(lambda f: f.cancelled() or f.exception())
 
     async def disconnect(self):
+        waited = time.perf_counter()
         async with self.lock:
+            BLE_LOCK_WAIT_SECONDS.observe(time.perf_counter() - waited)
+            self.connected.clear()
             if self.client is not None and self.client.is_connected:
                 try:
                     await self.client.disconnect()
@@ -45,8 +282,31 @@ class BLEManager:
                     pass
             self.client = None
 
+
+class BLEPool:
+    """One BLEManager per curtain address; each has its own queue and writer, so devices never wait on each other."""
+
+    def __init__(self):
+        self.managers = {}
+
+    def get(self, address):
+        manager = self.managers.get(address)
+        if manager is None:
+            manager = self.managers[address] = BLEManager(address)
+        manager.start()
+        return manager
+
+    async def stop(self):
+        await asyncio.gather(*(m.stop() for m in self.managers.values()), return_exceptions=True)
+
 DEVICE_ADDRESS = "BE:16:FA:00:03:7A"
 CHAR_UUID = "0000fff3-0000-1000-8000-00805f9b34fb"
+KEEPALIVE_PACKET = bytes([0x00])
+KEEPALIVE_INTERVAL = 5.0  # с простоя до проверочной записи
+WRITE_QUEUE_SIZE = 4
+MAX_WRITE_FAILURES = 3  # неудачных пачек подряд до переподключения
+CONNECT_WAIT = 20.0
+RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY = 0.5, 30.0
 
 
 CMD_MAP = {
@@ -63,16 +323,58 @@ CMD_MAP = {
 }
 
 
+def color_command(rgb):
+    """Solid colour frame in the CMD_MAP format."""
+    r, g, b = rgb
+    return bytearray((0x7e, 0x07, 0x05, 0x03, r, g, b, 0x10, 0xef))
+
+
 ROWS, COLS = 18, 20
 HALF_COLS = COLS // 2
+GAMES_PER_PANEL = 2
+MIN_GAME_COLS = 4  # лежачая палка I
+OPTIONS_PATH = "/data/options.json"
 FPS = 3
 TARGET_HEIGHT = ROWS / 2
 ALPHA, BETA, GAMMA = 1.0, 5.0, 2.0
 HELP_THRESHOLD = 14
-BRIGHTNESS = 1.0  # New global for brightness control (0.0 to 1.0)
+USE_NUMPY = np is not None  # пакетная оценка кандидатов через NumPy
+NUMPY_MIN_CANDIDATES = 200  # на меньших поисках (обновление фигуры) чистый Python быстрее
+FILL_COLOR_COMMANDS = False  # заливка цветом кадром CMD_MAP поверх режима светодиодов, на устройстве не проверена
+PLACEMENT_CACHE_SIZE = 4096
+LOOKAHEAD_DEPTH = 0  # сколько следующих фигур учитывает поиск, 0 — жадный выбор
+BEAM_WIDTH = 4
+SEARCH_BUDGET_SHARE = 0.2  # доля периода кадра на все поиски с просмотром вперёд за кадр
+SPECULATION_WORKERS = 1  # процессов для упреждающего поиска, 0 — выключено
+BRIGHTNESS = 1.0  # яркость при запуске (0.0–1.0); текущая — brightness_lut.brightness
+MAX_CATCHUP_STEPS = 2  # лишних шагов симуляции за кадр при отставании
+FRAME_STATS_WINDOW = 300
+FRAME_STATS_INTERVAL = 60.0  # с между сводками в лог
 game_tasks: list[asyncio.Task] = []
 stop_event = asyncio.Event()
 
+# Одна штора: адрес устройства, размер панели и число игр по ширине
+PanelConfig = namedtuple('PanelConfig', 'address rows cols games')
+
+
+def load_layout(path=OPTIONS_PATH):
+    """Curtains from the add-on options; the built-in DEVICE_ADDRESS panel if none are configured."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            devices = json.load(f).get('devices') or []
+    except FileNotFoundError:
+        devices = []
+    layout = [PanelConfig(d['address'], d.get('rows', ROWS), d.get('cols', COLS), d.get('games', GAMES_PER_PANEL))
+              for d in devices]
+    addresses = [cfg.address for cfg in layout]
+    if len(set(addresses)) != len(addresses):
+        raise ValueError(f"Адреса штор повторяются: {addresses}")
+    for cfg in layout:
+        if cfg.cols < cfg.games * MIN_GAME_COLS:
+            raise ValueError(f"{cfg.address}: {cfg.cols} колонок мало для {cfg.games} игр")
+    return layout or [PanelConfig(DEVICE_ADDRESS, ROWS, COLS, GAMES_PER_PANEL)]
+
+
 COLOR_PALETTE = [
     (10, 0, 80),
     (56, 0, 200),
@@ -90,67 +392,96 @@ INIT_CMDS = [
     bytearray.fromhex("7e07640101e00000" + "ff" * 70 + "ef"),
 ]
 
+# Индекс 0 — чёрный, далее цвета COLOR_PALETTE
+PALETTE = [COLOR_BLACK] + COLOR_PALETTE
+PALETTE_INDICES = range(1, len(PALETTE))
+
 def adjust_brightness(rgb, brightness):
     """Adjust color brightness by scaling RGB values."""
     return tuple(min(255, int(c * brightness)) for c in rgb)
 
-def rgb_to_hex_str(rgb):
-    return ''.join(f"{c:02x}" for c in rgb)
+
+class BrightnessLUT:
+    """RGB output for each palette index at the current brightness."""
+
+    def __init__(self, brightness):
+        self.version = 0
+        self.rebuild(brightness)
+
+    def rebuild(self, brightness):
+        self.brightness = brightness
+        self.rgb = [adjust_brightness(color, brightness) for color in PALETTE]
+        # Для произвольных RGB из /ws: bytes.translate по всему кадру
+        self.table = bytes(min(255, int(v * brightness)) for v in range(256))
+        self.version += 1
+
+
+brightness_lut = BrightnessLUT(BRIGHTNESS)
+
+PIXELS_PER_PACKET = 10
+PIXEL_SIZE = 5  # строка, колонка, R, G, B
+PACKET_HEADER = bytes.fromhex("7e0764")
+PACKET_SIZE = len(PACKET_HEADER) + PIXELS_PER_PACKET * PIXEL_SIZE + 1
+# Шаблон пакета: заголовок, пустые слоты ff, завершающий ef
+PACKET_TEMPLATE = PACKET_HEADER + b"\xff" * (PIXELS_PER_PACKET * PIXEL_SIZE) + b"\xef"
+_pack_pixel = struct.Struct("5B").pack_into
+
+
+def encode_pixel_packets(pixels):
+    """Encode (row, col, rgb) pixels into one contiguous buffer of back-to-back packets."""
+    count = -(-len(pixels) // PIXELS_PER_PACKET)
+    buf = bytearray(PACKET_TEMPLATE * count)
+    base = len(PACKET_HEADER)
+    slot = 0
+    for row, col, (r, g, b) in pixels:
+        _pack_pixel(buf, base, row, col, r, g, b)
+        slot += 1
+        if slot == PIXELS_PER_PACKET:
+            base += PACKET_SIZE - (PIXELS_PER_PACKET - 1) * PIXEL_SIZE
+            slot = 0
+        else:
+            base += PIXEL_SIZE
+    return buf
+
+
+def split_packets(buf):
+    view = memoryview(buf)
+    return [view[i:i + PACKET_SIZE] for i in range(0, len(buf), PACKET_SIZE)]
+
 
 def build_command_from_pixels(pixels):
     if not pixels:
         return []  # Возвращаем пустой список, если нет пикселей
-    commands = []
-    i = 0
-    while i < len(pixels):
-        chunk = pixels[i:i+10]
-        body = ""
-        for row, col, color in chunk:
-            body += f"{row:02x}{col:02x}{rgb_to_hex_str(color)}"
-        for _ in range(10 - len(chunk)):
-            body += "ffffffffff"
-        cmd = bytearray.fromhex("7e0764" + body + "ef")
-        commands.append(cmd)
-        i += 10
-    return commands
-
-async def send_commands(ble_manager, commands, retries=3, delay=2):
+    return split_packets(encode_pixel_packets(pixels))
+
+async def send_commands(ble_manager, commands, retries=3):
     if not commands:
         print("⚠️ Пропуск отправки: команды пусты")
         return
     for attempt in range(retries):
         try:
-            client = await ble_manager.get_client()
             for cmd in commands:
                 print(f"📦 Отправка BLE пакета: {cmd.hex()}")
-                async with asyncio.timeout(5.0):
-                    await client.write_gatt_char(CHAR_UUID, cmd, response=False)
-                ble_manager.last_successful_write = asyncio.get_event_loop().time()
+            await (await ble_manager.submit(commands))
             print(f"✅ Успешно отправлено {len(commands)} команд")
             return
         except Exception as e:
             print(f"❌ Ошибка при отправке BLE пакетов (попытка {attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                await asyncio.sleep(delay)
-            else:
-                await ble_manager.disconnect()
+            if attempt == retries - 1:
                 raise Exception(f"Не удалось отправить команды после {retries} попыток")
-    
-        
-async def send_control_command(ble_manager, cmd, retries=3, delay=1):
+            BLE_RETRIES.inc()
+
+
+async def send_control_command(ble_manager, cmd, retries=3):
     for attempt in range(retries):
         try:
-            client = await ble_manager.get_client()
-            await client.write_gatt_char(CHAR_UUID, cmd, response=False)
-            ble_manager.last_successful_write = asyncio.get_event_loop().time()
+            await (await ble_manager.submit([cmd]))
             return
         except Exception as e:
             print(f"Ошибка при отправке BLE команды (попытка {attempt+1}/{retries}): {e}")
-            if attempt < retries - 1:
-                await asyncio.sleep(delay)
-            else:
-                await ble_manager.disconnect()
+            if attempt == retries - 1:
                 raise
+            BLE_RETRIES.inc()
 
 
 async def enter_per_led_mode(ble_manager):
@@ -158,22 +489,707 @@ async def enter_per_led_mode(ble_manager):
         await send_commands(ble_manager, [cmd])
         await asyncio.sleep(0.05)
 
+
+RECORDINGS_DIR = "/data/recordings"
+RECORDING_MAGIC = b"THR1"
+# Запись индекса: смещение пачки команд в файле, её длина, номер шторы
+RECORDING_ENTRY = struct.Struct("<QIB")
+
+
+def recording_path(name):
+    """Path of a recording in RECORDINGS_DIR; only plain file names are accepted."""
+    if not name or name != os.path.basename(name) or name.startswith('.'):
+        raise ValueError(f"Недопустимое имя записи: {name!r}")
+    return os.path.join(RECORDINGS_DIR, name)
+
+
+class Recorder:
+    """Append-only log of everything the coalescers send.
+
+    <name> holds each flushed batch as length-prefixed commands, exactly as
+    written to the curtain; <name>.idx has one RECORDING_ENTRY per batch.
+    A fill is its own batch, so it stays recorded if the pixels after it fail.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = open(path, 'ab')
+        self.index = open(path + '.idx', 'ab')
+        if self.data.tell() == 0:
+            self.data.write(RECORDING_MAGIC)
+        self.batches = 0
+
+    def record(self, channel, commands):
+        offset = self.data.tell()
+        for cmd in commands:
+            self.data.write(bytes((len(cmd),)))
+            self.data.write(cmd)
+        self.index.write(RECORDING_ENTRY.pack(offset, self.data.tell() - offset, channel))
+        self.batches += 1
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+recorder: Recorder | None = None
+
+
+class PixelCoalescer:
+    """Latest-wins pixel map between the renderer and the BLE writer.
+
+    post() never waits for the link: each (row, col) keeps only its newest
+    colour, and the flush task sends just the net difference from what the
+    curtain is known to show whenever the previous write has finished.
+    With the device size known, shown covers every LED and a large change
+    may be sent as a fill plus the pixels that differ from it (see plan()).
+    """
+
+    def __init__(self, ble_manager, task_name="Coalescer", size=None, channel=0):
+        self.ble_manager = ble_manager
+        self.task_name = task_name
+        self.size = size  # (строки, колонки) в координатах устройства
+        self.channel = channel  # номер шторы в записи
+        self.pending = {}
+        self.shown = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.reset()
+
+    def reset(self):
+        """Forget what was shown and what was waiting: the curtain is blank."""
+        self.pending.clear()
+        self.wakeup.clear()
+        self.shown.clear()
+        if self.size:
+            rows, cols = self.size
+            self.shown.update(((r, c), COLOR_BLACK) for r in range(1, rows + 1) for c in range(1, cols + 1))
+
+    def plan(self, changed):
+        """Cheapest way to show changed, in BLE packets: (None, changed) or (fill colour, pixels after the fill).
+
+        Black fill is the per-LED mode re-entry, which leaves the curtain
+        blank; other colours use the CMD_MAP colour frame if FILL_COLOR_COMMANDS.
+        """
+        best_cost = -(-len(changed) // PIXELS_PER_PACKET)
+        if not self.size or best_cost <= (1 if FILL_COLOR_COMMANDS else len(INIT_CMDS)):
+            return None, changed
+        target = dict(self.shown)
+        for row, col, color in changed:
+            target[(row, col)] = color
+        counts = {}
+        for color in target.values():
+            counts[color] = counts.get(color, 0) + 1
+        fills = [(COLOR_BLACK, len(INIT_CMDS))]
+        common = max(counts, key=counts.get)
+        if FILL_COLOR_COMMANDS and common != COLOR_BLACK:
+            fills.append((common, 1))
+        best = None
+        for color, prefix in fills:
+            cost = prefix + -(-(len(target) - counts.get(color, 0)) // PIXELS_PER_PACKET)
+            if cost < best_cost:
+                best_cost, best = cost, color
+        if best is None:
+            return None, changed
+        return best, [(row, col, color) for (row, col), color in target.items() if color != best]
+
+    def keyframe(self):
+        """Commands that redraw what the curtain shows from scratch: per-LED mode, then every lit LED."""
+        lit = [(row, col, color) for (row, col), color in self.shown.items() if color != COLOR_BLACK]
+        return INIT_CMDS + build_command_from_pixels(lit)
+
+    def post(self, pixels):
+        pending = self.pending
+        before = len(pending)
+        for row, col, color in pixels:
+            pending[(row, col)] = color
+        FLUSH_SUPERSEDED.inc(before + len(pixels) - len(pending))
+        if pending:
+            self.wakeup.set()
+            if self.task is None:
+                self.task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _flush_loop(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            batch, self.pending = self.pending, {}
+            shown = self.shown
+            changed = [(row, col, color) for (row, col), color in batch.items()
+                       if shown.get((row, col), COLOR_BLACK) != color]
+            if not changed:
+                continue
+            pixels = changed
+            try:
+                fill, pixels = self.plan(changed)
+                cmds = build_command_from_pixels(pixels)
+                if fill is None:
+                    FLUSH_PACKETS.observe(len(cmds))
+                    print(f"📦 {self.task_name}: Отправка {len(changed)} пикселей, {len(cmds)} команд")
+                else:
+                    FLUSH_FILLS.inc()
+                    FLUSH_PACKETS.observe(len(cmds) + (len(INIT_CMDS) if fill == COLOR_BLACK else 1))
+                    print(f"📦 {self.task_name}: Заливка {fill} и {len(pixels)} пикселей, {len(cmds)} команд")
+                    if fill == COLOR_BLACK:
+                        await enter_per_led_mode(self.ble_manager)
+                        sent = INIT_CMDS
+                    else:
+                        sent = [color_command(fill)]
+                        await send_commands(self.ble_manager, sent)
+                    for key in shown:
+                        shown[key] = fill
+                    # Заливка уже на шторе, даже если пиксели поверх неё не дойдут
+                    if recorder is not None:
+                        recorder.record(self.channel, sent)
+                if cmds:
+                    await send_commands(self.ble_manager, cmds)
+                    if recorder is not None:
+                        recorder.record(self.channel, cmds)
+                for row, col, color in pixels:
+                    shown[(row, col)] = color
+            except Exception as e:
+                # Переподключение ведёт BLEManager; неотправленное возвращаем, если нет более свежего цвета
+                print(f"⚠️ {self.task_name}: Ошибка при отправке данных: {e}")
+                # После неудачной заливки пиксели поверх неё тоже нужно дослать
+                for row, col, color in changed + pixels:
+                    self.pending.setdefault((row, col), color)
+                self.wakeup.set()
+
+
+class Framebuffer:
+    """One palette index byte per LED of the panel."""
+
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.cells = bytearray(rows * cols)
+
+    def set(self, row, col, index):
+        """Store index at (row, col); True if the cell changed."""
+        i = row * self.cols + col
+        if self.cells[i] == index:
+            return False
+        self.cells[i] = index
+        return True
+
+    def lit(self):
+        cols = self.cols
+        for i, index in enumerate(self.cells):
+            if index:
+                yield i // cols, i % cols, index
+
+
+class FrameScheduler:
+    """Paces a loop on absolute deadlines of the event-loop clock.
+
+    An overrun frame does not push later frames back: the schedule stays
+    on its grid, up to MAX_CATCHUP_STEPS missed ticks are merged into the
+    next frame as extra simulation steps and the rest are skipped.
+    The period is read from FPS at every deadline.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.deadline = None
+        self.frame_start = None
+        self.catchup = 0
+        self.frames = 0
+        self.misses = 0
+        self.skipped = 0
+        self.frame_times = deque(maxlen=FRAME_STATS_WINDOW)
+        self.starts = deque(maxlen=FRAME_STATS_WINDOW)
+
+    def start_frame(self):
+        """Mark the start of a frame; returns how many simulation steps it should run."""
+        self.frame_start = self.loop.time()
+        if self.deadline is None:
+            self.deadline = self.frame_start
+        self.starts.append(self.frame_start)
+        steps, self.catchup = 1 + self.catchup, 0
+        return steps
+
+    async def end_frame(self):
+        now = self.loop.time()
+        self.frames += 1
+        self.frame_times.append(now - self.frame_start)
+        period = 1 / FPS
+        self.deadline += period
+        if now > self.deadline:
+            self.misses += 1
+            FRAME_MISSES.inc()
+            late = int((now - self.deadline) // period) + 1
+            self.catchup = min(late, MAX_CATCHUP_STEPS)
+            self.skipped += late - self.catchup
+            self.deadline += late * period
+        await asyncio.sleep(self.deadline - now)
+
+    def stats(self):
+        times = sorted(self.frame_times)
+        starts = self.starts
+
+        def pct(q):
+            return times[min(len(times) - 1, int(q * len(times)))] * 1000 if times else 0.0
+
+        span = starts[-1] - starts[0] if len(starts) > 1 else 0.0
+        return {
+            'fps': (len(starts) - 1) / span if span else 0.0,
+            'target_fps': FPS,
+            'frame_ms_p50': pct(0.50),
+            'frame_ms_p95': pct(0.95),
+            'frame_ms_p99': pct(0.99),
+            'frames': self.frames,
+            'misses': self.misses,
+            'skipped': self.skipped,
+        }
+
+    def summary(self):
+        st = self.stats()
+        return (f"{st['fps']:.1f}/{st['target_fps']:g} FPS, кадр p50 {st['frame_ms_p50']:.1f} мс, "
+                f"p95 {st['frame_ms_p95']:.1f} мс, p99 {st['frame_ms_p99']:.1f} мс, "
+                f"промахов {st['misses']}, пропущено тактов {st['skipped']}")
+
+
+frame_scheduler: FrameScheduler | None = None
+CallbackMetric("tetris_fps", "Achieved frames per second",
+               lambda: frame_scheduler.stats()['fps'] if frame_scheduler else 0.0)
+CallbackMetric("tetris_target_fps", "Configured FPS", lambda: FPS)
+
+
 # --- TetrisGame класс 
 TETROMINOS = {
-    'I': [(0, 0), (1, 0), (2, 0), (3, 0)],
-    'O': [(0, 0), (0, 1), (1, 0), (1, 1)],
-    'T': [(0, 1), (1, 0), (1, 1), (1, 2)],
-    'L': [(0, 0), (1, 0), (2, 0), (2, 1)],
-    'J': [(0, 1), (1, 1), (2, 1), (2, 0)],
-    'S': [(0, 1), (0, 2), (1, 0), (1, 1)],
-    'Z': [(0, 0), (0, 1), (1, 1), (1, 2)],
+    'I': ((0, 0), (1, 0), (2, 0), (3, 0)),
+    'O': ((0, 0), (0, 1), (1, 0), (1, 1)),
+    'T': ((0, 1), (1, 0), (1, 1), (1, 2)),
+    'L': ((0, 0), (1, 0), (2, 0), (2, 1)),
+    'J': ((0, 1), (1, 1), (2, 1), (2, 0)),
+    'S': ((0, 1), (0, 2), (1, 0), (1, 1)),
+    'Z': ((0, 0), (0, 1), (1, 1), (1, 2)),
 }
+PIECE_NAMES = tuple(TETROMINOS)
+
+_PIECE_MASKS = {}
+
+
+def piece_masks(blocks):
+    """Return (min_col, max_col, ((row, mask), ...)) for a piece, masks relative to min_col."""
+    key = tuple(blocks)
+    cached = _PIECE_MASKS.get(key)
+    if cached is None:
+        minc = min(c for _, c in blocks)
+        maxc = max(c for _, c in blocks)
+        rows = {}
+        for r, c in blocks:
+            rows[r] = rows.get(r, 0) | (1 << (c - minc))
+        cached = (minc, maxc, tuple(sorted(rows.items())))
+        _PIECE_MASKS[key] = cached
+    return cached
+
+
+_PIECE_COLUMNS = {}
+
+
+def piece_columns(blocks):
+    """Return (min_col, ((col_offset, rows), ...)) with the piece's rows in each column, top first."""
+    key = tuple(blocks)
+    cached = _PIECE_COLUMNS.get(key)
+    if cached is None:
+        minc = min(c for _, c in blocks)
+        cols = {}
+        for r, c in blocks:
+            cols.setdefault(c - minc, []).append(r)
+        cached = (minc, tuple((dc, tuple(sorted(rs))) for dc, rs in sorted(cols.items())))
+        _PIECE_COLUMNS[key] = cached
+    return cached
+
+
+# Все состояния поворота фигур, заполняются при импорте; ключ — кортеж клеток состояния
+PIECE_ROTATIONS = {}  # повороты, начиная с этого состояния
+NEXT_ROTATION = {}  # состояние после одного поворота в update()
+PIECE_BOUNDS = {}  # (min_col, max_col)
+PIECE_DEPTH = {}  # нижняя строка фигуры относительно её строки
+
+
+def _build_piece_tables():
+    for shape in TETROMINOS.values():
+        states = []
+        current = shape
+        while current not in states:
+            states.append(current)
+            current = tuple((-c, r) for r, c in current)
+        for i, state in enumerate(states):
+            PIECE_ROTATIONS[state] = tuple(states[i:] + states[:i])
+            NEXT_ROTATION[state] = states[(i + 1) % len(states)]
+            PIECE_BOUNDS[state] = piece_masks(state)[:2]
+            PIECE_DEPTH[state] = max(r for r, _ in state)
+            piece_columns(state)
+
+
+_build_piece_tables()
+
+
+def placement_score(avg_h, holes, variance, scale=1.0):
+    """Weighted board score; scale stretches TARGET_HEIGHT to panels taller or shorter than ROWS."""
+    return ALPHA * abs(avg_h - TARGET_HEIGHT * scale) + BETA * holes + GAMMA * variance
+
+
+class PlacementCache:
+    """LRU cache of search results keyed on board, piece and weights."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None, False
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value, True
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        while len(self.entries) > maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+placement_cache = PlacementCache(PLACEMENT_CACHE_SIZE)
+CallbackMetric("tetris_placement_cache_hits_total", "Placement cache hits", lambda: placement_cache.hits, "counter")
+CallbackMetric("tetris_placement_cache_misses_total", "Placement cache misses", lambda: placement_cache.misses, "counter")
+CallbackMetric("tetris_placement_cache_size", "Placement cache entries", lambda: len(placement_cache.entries))
+
+
+def placement_key(field, cols_count, blocks, row, col=None):
+    return (tuple(field), cols_count, blocks, row, col, ALPHA, BETA, GAMMA, TARGET_HEIGHT)
+
+
+speculation_pool: ProcessPoolExecutor | None = None
+
+
+def search_settings():
+    return ROWS, ALPHA, BETA, GAMMA, TARGET_HEIGHT, HELP_THRESHOLD
+
+
+def speculative_search(field, cols_count, settings):
+    """Run the searches the next spawn would need on field; returns [(cache key, placement)].
+
+    Executed in a worker process, so the module settings are taken from the caller.
+    """
+    global ROWS, ALPHA, BETA, GAMMA, TARGET_HEIGHT, HELP_THRESHOLD
+    ROWS, ALPHA, BETA, GAMMA, TARGET_HEIGHT, HELP_THRESHOLD = settings
+    game = TetrisGame.from_field(field, cols_count)
+    results = []
+    if game.needs_help():
+        best = game.find_placement(None, -2)
+        results.append((placement_key(field, cols_count, None, -2), best))
+        spawns = [best] if best else []
+    else:
+        spawns = [(blocks, cols_count // 2 - 1) for blocks in TETROMINOS.values()]
+    for blocks, col in spawns:
+        results.append((placement_key(field, cols_count, blocks, -2, col), game.find_placement(blocks, -2, col)))
+    return results
+
+
+def start_speculation_pool():
+    global speculation_pool
+    if SPECULATION_WORKERS > 0 and speculation_pool is None:
+        speculation_pool = ProcessPoolExecutor(SPECULATION_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+def stop_speculation_pool():
+    global speculation_pool
+    if speculation_pool is not None:
+        speculation_pool.shutdown(wait=False, cancel_futures=True)
+        speculation_pool = None
+
+
+_PIECE_ARRAYS = {}
+
+
+def batch_placement_scores(game, candidates):
+    """Score all (blocks, col) candidates for game in one NumPy pass; same values as game.evaluate()."""
+    rows_list, cols_list = [], []
+    for blocks, col in candidates:
+        key = tuple(blocks)
+        arrays = _PIECE_ARRAYS.get(key)
+        if arrays is None:
+            arrays = ([r for r, _ in blocks], [c for _, c in blocks])
+            _PIECE_ARRAYS[key] = arrays
+        rows_list.append(arrays[0])
+        cols_list.append([c + col for c in arrays[1]])
+    piece_r = np.array(rows_list)
+    piece_c = np.array(cols_list)
+    n = len(candidates)
+    rows = game.rows
+    tops = rows - np.array(game.heights)
+
+    # Строка падения: первая клетка, упершаяся в верх своей колонки
+    row = (tops[piece_c] - piece_r).min(axis=1) - 1
+    cell_r = row[:, None] + piece_r
+    placed = cell_r >= 0
+    new_top = np.tile(tops, (n, 1))
+    idx = np.arange(n)
+    for k in range(piece_r.shape[1]):
+        c = piece_c[:, k]
+        new_top[idx, c] = np.minimum(new_top[idx, c], np.where(placed[:, k], cell_r[:, k], rows))
+
+    holes = game.hole_count + tops.sum() - new_top.sum(axis=1) - placed.sum(axis=1)
+    heights = rows - new_top
+    avg_h = heights.sum(axis=1) / game.cols_count
+    variance = heights.max(axis=1) - heights.min(axis=1)
+    scores = ALPHA * np.abs(avg_h - TARGET_HEIGHT * game.height_scale) + BETA * holes + GAMMA * variance
+    for i in np.flatnonzero(row < -2):
+        # Пересечение со стаканом на строке появления — считаем как evaluate()
+        scores[i] = game.evaluate(*candidates[i])
+    return scores
+
+
+def fits(field, cols_count, blocks, row, col):
+    """True if the piece fits the bitboard at (row, col); rows above the top are free."""
+    minc, maxc, masks = piece_masks(blocks)
+    if col + minc < 0 or col + maxc >= cols_count:
+        return False
+    shift = col + minc
+    rows = len(field)
+    for r, mask in masks:
+        nr = row + r
+        if nr >= rows:
+            return False
+        if nr >= 0 and field[nr] & (mask << shift):
+            return False
+    return True
+
+
+def landing_row(field, blocks, col):
+    """Row where the piece comes to rest when dropped straight down from the spawn row."""
+    minc, _, masks = piece_masks(blocks)
+    shift = col + minc
+    shifted = [(r, mask << shift) for r, mask in masks]
+    rows = len(field)
+    row = -2
+    while True:
+        nxt = row + 1
+        for r, mask in shifted:
+            nr = nxt + r
+            if nr >= rows or (nr >= 0 and field[nr] & mask):
+                return row
+        row = nxt
+
+
+def drop_piece(field, blocks, col):
+    """New bitboard with the piece dropped straight down at col, before line clears."""
+    row = landing_row(field, blocks, col)
+    minc, _, masks = piece_masks(blocks)
+    shift = col + minc
+    placed = list(field)
+    for r, mask in masks:
+        nr = row + r
+        if 0 <= nr < len(field):
+            placed[nr] |= mask << shift
+    return placed
+
+
+def _controller_step(state, free, last, lo, hi):
+    """One _step() from a (blocks, row, col, direction, turning) state shared by all targets it stands for.
+
+    direction is -1/+1 while the target column is still to the left/right and
+    0 once the piece is in it; turning is True while a rotation is still due.
+    Returns the (blocks, row, col) where targets got aligned during the step
+    and the states that fall on to the next row.
+    """
+    b, r, c, d, turning = state
+    moved = d != 0 and free(b, r, c + d)
+    if moved:
+        c += d
+    turned = turning and r >= 3 and free(NEXT_ROTATION[b], r, c)
+    if turned:
+        b = NEXT_ROTATION[b]
+    aligned, falling = [], []
+    falls = None
+    for nd in ((0, d) if moved else (d,)):
+        if nd and not (c < hi if nd > 0 else c > lo):
+            continue
+        for nt in (((False, True) if b != last else (False,)) if turned else (turning,)):
+            if not nd and not nt:
+                aligned.append((b, r, c))
+                continue
+            if falls is None:
+                falls = free(b, r + 1, c)
+            if falls:
+                falling.append((b, r + 1, c, nd, nt))
+    return aligned, falling
+
+
+# Шаг на пустом стакане: reach — нижняя строка, которой касаются его проверки,
+# deepest — то же для всего поддерева, targets — все выровненные в поддереве цели
+OpenStep = namedtuple('OpenStep', 'state reach aligned children deepest targets')
+_OPEN_PATHS = {}
+
+
+def _start_states(blocks, row, col, lo, hi):
+    turns = (False, True) if blocks != PIECE_ROTATIONS[blocks][-1] else (False,)
+    return [(blocks, row, col, d, turning) for d in (-1, 0, 1)
+            if d == 0 or (col < hi if d > 0 else col > lo) for turning in turns]
+
+
+def _open_paths(blocks, row, col, cols_count, lo, hi):
+    """The controller's steps from (blocks, row, col) on a board with nothing but walls, computed once;
+    returns (root OpenSteps, every (rotation, column) in output order)."""
+    key = (blocks, row, col, cols_count)
+    paths = _OPEN_PATHS.get(key)
+    if paths is not None:
+        return paths
+    last = PIECE_ROTATIONS[blocks][-1]
+
+    def free(b, r, c):
+        minc, maxc = PIECE_BOUNDS[b]
+        return c + minc >= 0 and c + maxc < cols_count
+
+    def build(state):
+        b, r = state[0], state[1]
+        aligned, falling = _controller_step(state, free, last, lo, hi)
+        reach = r + 1 + max(PIECE_DEPTH[b], PIECE_DEPTH[NEXT_ROTATION[b]] if state[4] and r >= 3 else 0)
+        # Со строки 3 шаг без сдвига и поворота повторялся бы до фиксации — целей дальше нет
+        children = [build(s) for s in falling if r < 3 or s[2:] != state[2:] or s[0] != b]
+        here = [(tb, tc) for tb, _, tc in aligned]
+        targets = list(here)
+        deepest = reach
+        for child in children:
+            targets += child.targets
+            deepest = max(deepest, child.deepest)
+        return OpenStep(state, reach, here, children, deepest, targets)
+
+    roots = [build(state) for state in _start_states(blocks, row, col, lo, hi)]
+    # Все (поворот, колонка) в порядке candidate_placements(), чтобы ничьи решались как там
+    moves = [(b, c) for b in PIECE_ROTATIONS[blocks]
+             for c in range(-PIECE_BOUNDS[b][0], cols_count - PIECE_BOUNDS[b][1])]
+    _OPEN_PATHS[key] = paths = (roots, moves)
+    return paths
+
+
+def reachable_placements(field, cols_count, blocks, row, col):
+    """(rotation, column) targets the update() controller can steer the piece at (blocks, row, col) into.
+
+    _step() depends on its target only through the direction still to shift
+    and whether a rotation is still due, so all targets are walked in one pass
+    over shared states (see _controller_step). A target counts if the piece
+    gets aligned with it no lower than its straight-drop row, the position
+    evaluate() scores. Steps above the stack only meet the walls and are
+    taken from _open_paths(); the board is checked from where they reach it.
+    """
+    rotations = PIECE_ROTATIONS[blocks]
+    last = rotations[-1]
+    # Крайние колонки целей среди всех поворотов
+    lo = min(-PIECE_BOUNDS[b][0] for b in rotations)
+    hi = max(cols_count - 1 - PIECE_BOUNDS[b][1] for b in rotations)
+    # Выше верхней занятой строки фигуре мешают только стенки
+    top = next((r for r, bits in enumerate(field) if bits), len(field))
+
+    roots, moves = _open_paths(blocks, row, col, cols_count, lo, hi)
+    found = set()
+    live = []
+    pending = list(roots)
+    while pending:
+        node = pending.pop()
+        if node.deepest < top:
+            found.update(node.targets)
+        elif node.reach < top:
+            found.update(node.aligned)
+            pending.extend(node.children)
+        else:
+            live.append(node.state)
+
+    def free(b, r, c):
+        minc, maxc = PIECE_BOUNDS[b]
+        if c + minc < 0 or c + maxc >= cols_count:
+            return False
+        return r + PIECE_DEPTH[b] < top or fits(field, cols_count, b, r, c)
+
+    landing = {}
+    seen = set()
+    while live:
+        state = live.pop()
+        if state in seen:
+            continue
+        seen.add(state)
+        aligned, falling = _controller_step(state, free, last, lo, hi)
+        for b, r, c in aligned:
+            if r + PIECE_DEPTH[b] >= top:
+                if (b, c) not in landing:
+                    landing[b, c] = landing_row(field, b, c)
+                if r > landing[b, c] or not free(b, row, c):
+                    continue
+            found.add((b, c))
+        live.extend(falling)
+    return [move for move in moves if move in found]
+
+
+def clear_lines(field, cols_count):
+    """Bitboard with full rows removed; returns (field, lines cleared)."""
+    full = (1 << cols_count) - 1
+    kept = [bits for bits in field if bits != full]
+    cleared = len(field) - len(kept)
+    return [0] * cleared + kept, cleared
+
+
+def board_score(field, cols_count, scale=1.0):
+    heights, holes = board_profile(field, cols_count)
+    return placement_score(sum(heights) / cols_count, holes, max(heights) - min(heights), scale)
+
+
+def board_profile(field, cols_count):
+    """Column heights and hole count of a bitboard, scanning rows top to bottom."""
+    heights = [0] * cols_count
+    holes = 0
+    seen = 0
+    rows = len(field)
+    for r, row in enumerate(field):
+        holes += (seen & ~row).bit_count()
+        new = row & ~seen
+        while new:
+            low = new & -new
+            heights[low.bit_length() - 1] = rows - r
+            new ^= low
+        seen |= row
+    return heights, holes
 
 
 class TetrisGame:
-    def __init__(self, cols_start, cols_count, seed=None):
+    def __init__(self, cols_start, cols_count, seed=None, rows=None):
         self.cols_start = cols_start
         self.cols_count = cols_count
+        self.rows = rows = rows or ROWS
+        # TARGET_HEIGHT и HELP_THRESHOLD заданы для стакана высотой ROWS
+        self.height_scale = rows / ROWS
 
         import time
         if seed is None:
@@ -182,89 +1198,319 @@ class TetrisGame:
             base = seed
         self.rng = random.Random(base)
 
-        self.field = [[False] * cols_count for _ in range(ROWS)]
-        self.color_field = [[COLOR_BLACK for _ in range(cols_count)] for _ in range(ROWS)]
+        # Битовое поле: одна маска на строку, бит c — занятая колонка c
+        self.field = [0] * rows
+        self.full_mask = (1 << cols_count) - 1
+        # Индексы палитры по клеткам, 0 — пусто
+        self.color_field = [bytearray(cols_count) for _ in range(rows)]
+        self._reset_surface()
         self.piece_blocks = []
         self.piece_row = -2
         self.piece_col = cols_count // 2 - 1
-        self.piece_color = COLOR_PALETTE[0]
+        self.piece_color = PALETTE_INDICES[0]
         self.game_over = False
         self.locked_pieces_count = 0
+        self.lines_cleared = 0
+        self.assisted_spawns = 0  # фигуры, выбранные ИИ после HELP_THRESHOLD
+        self.search_seconds = 0.0
         self.target_blocks = None
         self.target_col = None
+        # Следующие фигуры, заранее вытянутые из rng для поиска с просмотром вперёд
+        self.preview = deque()
+        # Клетки, изменившиеся с прошлого кадра (координаты поля игры)
+        self.dirty = set()
+        # Упреждающий поиск для следующей фигуры: (future, ожидаемое поле)
+        self.speculation = None
         self.spawn_new_piece()
+        self._mark_piece()
+
+    @classmethod
+    def from_field(cls, field, cols_count):
+        """Board-only instance for searches off the event loop: no piece, rng or render state."""
+        game = cls.__new__(cls)
+        game.cols_start = 0
+        game.cols_count = cols_count
+        game.rows = len(field)
+        game.height_scale = game.rows / ROWS
+        game.field = list(field)
+        game.full_mask = (1 << cols_count) - 1
+        game.search_seconds = 0.0
+        game._reset_surface()
+        for c in range(cols_count):
+            game._rescan_column(c)
+        game._refresh_extremes()
+        return game
+
+    def _reset_surface(self):
+        # Профиль поверхности, обновляется инкрементально при фиксации фигур
+        cols_count = self.cols_count
+        self.heights = [0] * cols_count
+        self.col_holes = [0] * cols_count
+        self.hole_count = 0
+        self.height_sum = 0
+        self.height_hist = [0] * (self.rows + 1)
+        self.height_hist[0] = cols_count
+        self.min_h = self.max_h = 0
 
     def can_place(self, blocks, row, col):
-        for r, c in blocks:
-            nr, nc = row + r, col + c
-            if nc < 0 or nc >= self.cols_count or nr >= ROWS:
-                return False
-            if nr >= 0 and self.field[nr][nc]:
-                return False
-        return True
+        return fits(self.field, self.cols_count, blocks, row, col)
 
     def get_rotations(self, blocks):
-        seen = set()
-        rotations = []
-        current = list(blocks)
-        for _ in range(4):
-            norm = tuple(sorted(current))
-            if norm in seen:
-                break
-            seen.add(norm)
-            rotations.append(list(current))
-            current = [(-c, r) for r, c in current]
-        return rotations
+        return PIECE_ROTATIONS[blocks]
+
+    def drop_row(self, blocks, col):
+        return landing_row(self.field, blocks, col)
 
     def simulate(self, blocks, col):
-        temp = [row[:] for row in self.field]
-        row = -2
-        while self.can_place(blocks, row + 1, col):
-            row += 1
-        for r, c in blocks:
-            nr, nc = row + r, col + c
-            if 0 <= nr < ROWS:
-                temp[nr][nc] = True
-        heights, holes = [], 0
-        for c in range(self.cols_count):
-            seen = False
-            h = 0
-            for r in range(ROWS):
-                if temp[r][c]:
-                    if not seen:
-                        h = ROWS - r
-                        seen = True
-                elif seen:
-                    holes += 1
-            heights.append(h)
+        temp = list(self.field)
+        row = self.drop_row(blocks, col)
+        minc, _, masks = piece_masks(blocks)
+        shift = col + minc
+        for r, mask in masks:
+            nr = row + r
+            if 0 <= nr < self.rows:
+                temp[nr] |= mask << shift
+        heights, holes = board_profile(temp, self.cols_count)
         avg_h = sum(heights) / self.cols_count
         return avg_h, holes, heights
 
+    def evaluate(self, blocks, col):
+        """Score a straight drop at col from the tracked surface, touching only the piece's columns."""
+        minc, columns = piece_columns(blocks)
+        base = col + minc
+        heights = self.heights
+        rows = land = self.rows
+        for dc, rs in columns:
+            t = rows - heights[base + dc] - rs[-1]
+            if t < land:
+                land = t
+        row = land - 1
+        if row < -2:
+            # Фигура уже пересекается со стаканом на строке появления — честный пересчёт
+            avg_h, holes, hs = self.simulate(blocks, col)
+            return placement_score(avg_h, holes, max(hs) - min(hs), self.height_scale)
+
+        holes = self.hole_count
+        height_sum = self.height_sum
+        max_h = self.max_h
+        touched_min = rows + 1
+        old_hs = []
+        for dc, rs in columns:
+            if row + rs[-1] < 0:
+                continue
+            old_h = heights[base + dc]
+            if row + rs[0] >= 0:
+                top, placed = row + rs[0], len(rs)
+            else:
+                visible = [r for r in rs if row + r >= 0]
+                top, placed = row + visible[0], len(visible)
+            holes += rows - old_h - top - placed
+            new_h = rows - top
+            height_sum += new_h - old_h
+            old_hs.append(old_h)
+            if new_h > max_h:
+                max_h = new_h
+            if new_h < touched_min:
+                touched_min = new_h
+
+        min_h = touched_min
+        hist = self.height_hist
+        for h in range(self.min_h, touched_min):
+            if hist[h] > old_hs.count(h):
+                min_h = h
+                break
+        return placement_score(height_sum / self.cols_count, holes, max_h - min_h, self.height_scale)
+
+    def candidate_placements(self, shapes, row):
+        """All (rotation, column) pairs of the given shapes that fit at row."""
+        candidates = []
+        for shape in shapes:
+            for blocks in PIECE_ROTATIONS[shape]:
+                minc, maxc = PIECE_BOUNDS[blocks]
+                for col in range(-minc, self.cols_count - maxc):
+                    if self.can_place(blocks, row, col):
+                        candidates.append((blocks, col))
+        return candidates
+
+    def pick_placement(self, candidates):
+        """Lowest-scoring candidate (first one on ties), or None."""
+        if not candidates:
+            return None
+        if USE_NUMPY and np is not None and len(candidates) >= NUMPY_MIN_CANDIDATES:
+            scores = batch_placement_scores(self, candidates)
+            return candidates[int(np.argmin(scores))]
+        best_score, best = float('inf'), None
+        for blocks, col in candidates:
+            score = self.evaluate(blocks, col)
+            if score < best_score:
+                best_score, best = score, (blocks, col)
+        return best
+
+    def find_placement(self, blocks, row, col=None):
+        """Best placement, via placement_cache: for the piece at (blocks, row, col) among those it can reach,
+        or for any shape placed directly at row if blocks is None."""
+        key = placement_key(self.field, self.cols_count, blocks, row, col)
+        best, found = placement_cache.get(key)
+        if not found:
+            started = time.perf_counter()
+            if blocks is None:
+                candidates = self.candidate_placements(TETROMINOS.values(), row)
+            else:
+                candidates = reachable_placements(self.field, self.cols_count, blocks, row, col)
+            best = self.pick_placement(candidates)
+            placement_cache.put(key, best)
+            elapsed = time.perf_counter() - started
+            self.search_seconds += elapsed
+            AI_SEARCH_SECONDS['spawn' if blocks is None else 'update'].observe(elapsed)
+        return best
+
+    def _next_shape(self):
+        if self.preview:
+            return self.preview.popleft()
+        return self.rng.choice(PIECE_NAMES)
+
+    def upcoming_shapes(self, count):
+        """The next count random pieces, drawn from rng ahead of time."""
+        while len(self.preview) < count:
+            self.preview.append(self.rng.choice(PIECE_NAMES))
+        return [TETROMINOS[name] for name in islice(self.preview, count)]
+
+    def lookahead_placement(self, deadline=None):
+        """Beam search over the current piece and LOOKAHEAD_DEPTH previewed ones.
+
+        Each placement is scored like the greedy search (before its own line
+        clears), and the cleared board is carried to the next level. Only
+        reachable placements are expanded; previewed pieces are taken to
+        spawn in the middle column, as random spawns do. Stops at deadline
+        (perf_counter() seconds; SEARCH_BUDGET_SHARE of the frame period from
+        now if None): mid-level, the best first move of the last complete
+        level wins, and before the first level completes, the greedy choice.
+        """
+        if deadline is None:
+            deadline = time.perf_counter() + SEARCH_BUDGET_SHARE / FPS
+        cols = self.cols_count
+        beam = []
+        for move in reachable_placements(self.field, cols, self.piece_blocks, self.piece_row, self.piece_col):
+            if time.perf_counter() > deadline:
+                return self.find_placement(self.piece_blocks, self.piece_row, self.piece_col)
+            placed = drop_piece(self.field, *move)
+            beam.append((board_score(placed, cols, self.height_scale), clear_lines(placed, cols)[0], move))
+        if not beam:
+            return None
+        beam.sort(key=itemgetter(0))
+        best = beam[0][2]
+        spawn_col = cols // 2 - 1
+        for shape in self.upcoming_shapes(LOOKAHEAD_DEPTH):
+            children = []
+            for _, field, move in beam[:BEAM_WIDTH]:
+                if time.perf_counter() > deadline:
+                    return best
+                for blocks, col in reachable_placements(field, cols, shape, -2, spawn_col):
+                    if time.perf_counter() > deadline:
+                        return best
+                    placed = drop_piece(field, blocks, col)
+                    children.append((board_score(placed, cols, self.height_scale), clear_lines(placed, cols)[0], move))
+            if not children:
+                break
+            children.sort(key=itemgetter(0))
+            beam = children
+            best = beam[0][2]
+        return best
+
+    def _speculate(self):
+        """Start the next spawn's searches in a worker on the board expected after this piece locks."""
+        if speculation_pool is None or self.speculation is not None:
+            return
+        predicted, _ = clear_lines(drop_piece(self.field, self.target_blocks, self.target_col), self.cols_count)
+        try:
+            future = speculation_pool.submit(speculative_search, predicted, self.cols_count, search_settings())
+        except RuntimeError:  # пул уже остановлен
+            return
+        self.speculation = (future, predicted)
+
+    def _collect_speculation(self):
+        """Reuse finished speculative results if the board matches the prediction, else drop them."""
+        if self.speculation is None:
+            return
+        future, predicted = self.speculation
+        self.speculation = None
+        if not future.done() or future.cancelled() or future.exception() is not None:
+            # Ещё не начатый поиск снимаем, чтобы не задерживал следующие в очереди процесса
+            future.cancel()
+            SPECULATION_RESULTS['late'].inc()
+        elif self.field != predicted:
+            SPECULATION_RESULTS['discarded'].inc()
+        else:
+            SPECULATION_RESULTS['used'].inc()
+            for key, best in future.result():
+                placement_cache.put(key, best)
+
     def max_height(self):
-        m = 0
-        for c in range(self.cols_count):
-            for r in range(ROWS):
-                if self.field[r][c]:
-                    m = max(m, ROWS - r)
-                    break
-        return m
+        return self.max_h
+
+    def needs_help(self):
+        """True once the stack is high enough for the AI to pick the next piece."""
+        return self.max_h >= HELP_THRESHOLD * self.height_scale
+
+    def _set_height(self, c, h):
+        heights = self.heights
+        old_h = heights[c]
+        if old_h == h:
+            return
+        heights[c] = h
+        self.height_sum += h - old_h
+        self.height_hist[old_h] -= 1
+        self.height_hist[h] += 1
+
+    def _rescan_column(self, c):
+        bit = 1 << c
+        h = holes = 0
+        rows = self.rows
+        for r in range(rows):
+            if self.field[r] & bit:
+                if not h:
+                    h = rows - r
+            elif h:
+                holes += 1
+        self.hole_count += holes - self.col_holes[c]
+        self.col_holes[c] = holes
+        self._set_height(c, h)
+
+    def _refresh_extremes(self):
+        hist = self.height_hist
+        self.min_h = next(h for h in range(self.rows + 1) if hist[h])
+        self.max_h = next(h for h in range(self.rows, -1, -1) if hist[h])
+
+    def _track_lock(self):
+        """Update the surface profile for the piece just written into the field."""
+        minc, columns = piece_columns(self.piece_blocks)
+        base = self.piece_col + minc
+        row = self.piece_row
+        rows = self.rows
+        for dc, rs in columns:
+            c = base + dc
+            visible = [r for r in rs if row + r >= 0]
+            if not visible:
+                continue
+            old_top = rows - self.heights[c]
+            if row + visible[-1] < old_top:
+                top = row + visible[0]
+                added = old_top - top - len(visible)
+                self.col_holes[c] += added
+                self.hole_count += added
+                self._set_height(c, rows - top)
+            else:
+                # Фигура задвинута под навес — пересчитываем колонку целиком
+                self._rescan_column(c)
+        self._refresh_extremes()
 
     def spawn_new_piece(self):
+        self._collect_speculation()
         start_col = self.cols_count // 2 - 1
-        if self.max_height() >= HELP_THRESHOLD:
+        if self.needs_help():
             # Use AI to find the best piece and position
-            best_score, best = float('inf'), None
-            for shape in TETROMINOS.values():
-                for blocks in self.get_rotations(shape):
-                    minc, maxc = min(c for _, c in blocks), max(c for _, c in blocks)
-                    for col in range(-minc, self.cols_count - maxc):
-                        if not self.can_place(blocks, -2, col):
-                            continue
-                        avg_h, holes, heights = self.simulate(blocks, col)
-                        variance = max(heights) - min(heights)
-                        score = ALPHA * abs(avg_h - TARGET_HEIGHT) + BETA * holes + GAMMA * variance
-                        if score < best_score:
-                            best_score, best = score, (blocks, col)
+            best = self.find_placement(None, -2)
+            self.assisted_spawns += 1
             if best:
                 self.piece_blocks, self.piece_col = best
             else:
@@ -272,8 +1518,7 @@ class TetrisGame:
                 return
         else:
             # Randomly select a piece
-            choice = self.rng.choice(list(TETROMINOS.keys()))
-            blocks0 = TETROMINOS[choice]
+            blocks0 = TETROMINOS[self._next_shape()]
             if self.can_place(blocks0, -2, start_col):
                 self.piece_blocks = blocks0
                 self.piece_col = start_col
@@ -282,29 +1527,52 @@ class TetrisGame:
                 return
 
         self.piece_row = -2
-        self.piece_color = self.rng.choice(COLOR_PALETTE)
+        self.piece_color = self.rng.choice(PALETTE_INDICES)
         self.target_blocks = None
         self.target_col = None
         if not self.can_place(self.piece_blocks, self.piece_row, self.piece_col):
             self.game_over = True
 
-    def update(self):
+    def update(self, deadline=None):
+        """One simulation step; deadline bounds a lookahead search started by it (see lookahead_placement)."""
         if self.game_over:
             return
+        self._mark_piece()
+        self._step(deadline)
+        self._mark_piece()
+
+    def _mark_piece(self):
+        for r, c in self.piece_blocks:
+            nr = self.piece_row + r
+            if 0 <= nr < self.rows:
+                self.dirty.add((nr, self.piece_col + c))
+
+    def pop_changes(self):
+        """(row, col, palette index) for every cell changed since the last call, in game coordinates."""
+        if not self.dirty:
+            return []
+        piece = {(self.piece_row + r, self.piece_col + c) for r, c in self.piece_blocks}
+        colors = self.color_field
+        changes = []
+        for r, c in self.dirty:
+            changes.append((r, c, self.piece_color if (r, c) in piece else colors[r][c]))
+        self.dirty.clear()
+        return changes
+
+    def _step(self, deadline=None):
         # Determine target
         if self.target_blocks is None:
-            best_score, best = float('inf'), None
-            for blocks in self.get_rotations(self.piece_blocks):
-                minc, maxc = min(c for _, c in blocks), max(c for _, c in blocks)
-                for col in range(-minc, self.cols_count - maxc):
-                    if not self.can_place(blocks, self.piece_row, col):
-                        continue
-                    avg_h, holes, heights = self.simulate(blocks, col)
-                    variance = max(heights) - min(heights)
-                    score = ALPHA * abs(avg_h - TARGET_HEIGHT) + BETA * holes + GAMMA * variance
-                    if score < best_score:
-                        best_score, best = score, (blocks, col)
+            if LOOKAHEAD_DEPTH > 0:
+                started = time.perf_counter()
+                best = self.lookahead_placement(deadline)
+                elapsed = time.perf_counter() - started
+                self.search_seconds += elapsed
+                AI_SEARCH_SECONDS['lookahead'].observe(elapsed)
+            else:
+                best = self.find_placement(self.piece_blocks, self.piece_row, self.piece_col)
             self.target_blocks, self.target_col = best if best else (self.piece_blocks, self.piece_col)
+            if LOOKAHEAD_DEPTH == 0:
+                self._speculate()
         # Move towards target
         if self.piece_col < self.target_col and self.can_place(self.piece_blocks, self.piece_row, self.piece_col + 1):
             self.piece_col += 1
@@ -312,9 +1580,8 @@ class TetrisGame:
             self.piece_col -= 1
         # Rotate if possible, only when piece_row >= 3
         if self.piece_blocks != self.target_blocks and self.piece_row >= 3:
-            rots = self.get_rotations(self.piece_blocks)
-            if self.target_blocks in rots:
-                next_block = rots[(rots.index(self.piece_blocks) + 1) % len(rots)]
+            if self.target_blocks in PIECE_ROTATIONS[self.piece_blocks]:
+                next_block = NEXT_ROTATION[self.piece_blocks]
                 if self.can_place(next_block, self.piece_row, self.piece_col):
                     self.piece_blocks = next_block
                     
@@ -325,104 +1592,277 @@ class TetrisGame:
             self.lock_piece()
 
     def lock_piece(self):
+        minc, _, masks = piece_masks(self.piece_blocks)
+        shift = self.piece_col + minc
+        rows = self.rows
+        for r, mask in masks:
+            nr = self.piece_row + r
+            if 0 <= nr < rows:
+                self.field[nr] |= mask << shift
         for r, c in self.piece_blocks:
             nr, nc = self.piece_row + r, self.piece_col + c
-            if 0 <= nr < ROWS:
-                self.field[nr][nc] = True
+            if 0 <= nr < rows:
                 self.color_field[nr][nc] = self.piece_color
+        self._mark_piece()
         self.locked_pieces_count += 1
+        self._track_lock()
         # Clear lines
         new_f, new_c, cleared = [], [], 0
-        for r in range(ROWS):
-            if all(self.field[r]):
+        for r in range(rows):
+            if self.field[r] == self.full_mask:
                 cleared += 1
+                lowest_cleared = r
             else:
                 new_f.append(self.field[r])
                 new_c.append(self.color_field[r])
         for _ in range(cleared):
-            new_f.insert(0, [False] * self.cols_count)
-            new_c.insert(0, [COLOR_BLACK] * self.cols_count)
+            new_f.insert(0, 0)
+            new_c.insert(0, bytearray(self.cols_count))
         self.field, self.color_field = new_f, new_c
-        self.spawn_new_piece()
-    
-    def render(self, led_matrix):
-        for r in range(ROWS):
+        self.lines_cleared += cleared
+        if cleared:
             for c in range(self.cols_count):
-                led_matrix[r + 1][c + self.cols_start + 1] = adjust_brightness(self.color_field[r][c], BRIGHTNESS) if self.field[r][c] else COLOR_BLACK
-        for r, c in self.piece_blocks:
-            nr, nc = self.piece_row + r + 1, self.piece_col + c + self.cols_start + 1
-            if 0 <= nr < ROWS + 2 and 0 <= nc < COLS + 2:
-                led_matrix[nr][nc] = adjust_brightness(self.piece_color, BRIGHTNESS)
+                self._rescan_column(c)
+            self._refresh_extremes()
+            # Все строки над нижней очищенной сдвинулись
+            self.dirty.update((r, c) for r in range(lowest_cleared + 1) for c in range(self.cols_count))
+        self.spawn_new_piece()
 # -----------------------
-async def single_game_loop(ble_manager, cols_start, cols_count, seed=None):
-    game = TetrisGame(cols_start, cols_count, seed=seed)
-    led_matrix = [[COLOR_BLACK]*(COLS+2) for _ in range(ROWS+2)]
-    prev_matrix = [row[:] for row in led_matrix]
-    task_name = f"Task_{'left' if cols_start == 0 else 'right'}"
+class Curtain:
+    """A configured device and its pixel coalescer, shared by the games and /ws streams."""
+
+    def __init__(self, config, ble_manager, channel=0):
+        self.config = config
+        self.ble_manager = ble_manager
+        self.channel = channel
+        self.coalescer = PixelCoalescer(ble_manager, f"Curtain_{config.address}", (config.cols, config.rows), channel)
+        self.per_led = False
+        # Последний кадр из /ws (RGB по строкам матрицы); None — сравнивать не с чем
+        self.frame = None
+
+    async def prepare(self):
+        """Connect and enter per-LED mode; the curtain is then assumed blank."""
+        await self.ble_manager.get_client()
+        # Незаконченная отправка прошлого сеанса не должна лечь поверх чистой шторы
+        await self.coalescer.stop()
+        await enter_per_led_mode(self.ble_manager)
+        self.coalescer.reset()
+        self.frame = None
+        self.per_led = True
+
+    def post_frame(self, rgb):
+        """Post a rows*cols*3 RGB frame, only the pixels that differ from the previous one."""
+        rows, cols = self.config.rows, self.config.cols
+        rgb = rgb.translate(brightness_lut.table)
+        prev = self.frame
+        changed = []
+        i = 0
+        for r in range(rows):
+            for c in range(cols):
+                color = rgb[i:i + 3]
+                if prev is None or prev[i:i + 3] != color:
+                    changed.append((c + 1, rows - r, tuple(color)))
+                i += 3
+        self.frame = rgb
+        self.coalescer.post(changed)
+        return len(changed)
+
+    def post_delta(self, deltas):
+        """Post (row, col, r, g, b) records; the next full frame is compared against nothing."""
+        rows, table = self.config.rows, brightness_lut.table
+        self.frame = None
+        self.coalescer.post([(c + 1, rows - r, (table[red], table[green], table[blue]))
+                             for r, c, red, green, blue in deltas])
+
+    def snapshot(self):
+        """What the curtain shows or is about to show, as rows*cols*3 RGB in matrix orientation."""
+        rows, cols = self.config.rows, self.config.cols
+        buf = bytearray(rows * cols * 3)
+        for state in (self.coalescer.shown, self.coalescer.pending):
+            for (row, col), color in state.items():
+                i = ((rows - col) * cols + row - 1) * 3
+                buf[i:i + 3] = bytes(color)
+        return buf
+
+
+class Panel:
+    """The games side by side on one curtain and their palette framebuffer."""
+
+    def __init__(self, curtain, seed_base):
+        config = curtain.config
+        self.address = config.address
+        self.rows, self.cols = config.rows, config.cols
+        self.framebuffer = Framebuffer(config.rows, config.cols)
+        self.coalescer = curtain.coalescer
+        width, extra = divmod(config.cols, config.games)
+        self.games = []
+        start = 0
+        for i in range(config.games):
+            cols_count = width + (i < extra)
+            self.games.append(TetrisGame(start, cols_count, seed=seed_base + start, rows=config.rows))
+            start += cols_count
+
+
+async def compositor_loop(panels):
+    """Tick the games of all curtains on one clock and post each framebuffer diff to its own coalescer."""
+    task_name = "Task_compositor"
+    lut_version = brightness_lut.version
+    global frame_scheduler
+    scheduler = frame_scheduler = FrameScheduler()
+    loop = asyncio.get_running_loop()
+    last_report = time.monotonic()
 
     try:
         while True:
-            game.update()
-            for r in range(ROWS+2):
-                for c in range(COLS+2):
-                    led_matrix[r][c] = COLOR_BLACK
-            game.render(led_matrix)
-
-            changed = []
-            for r in range(1, ROWS+1):
-                for c in range(1, COLS+1):
-                    if led_matrix[r][c] != prev_matrix[r][c]:
-                        rotated_row = c
-                        rotated_col = ROWS - r + 1
-                        changed.append((rotated_row, rotated_col, led_matrix[r][c]))
-            prev_matrix = [row[:] for row in led_matrix]
-
-            try:
+            steps = scheduler.start_frame()
+            # Общий бюджет поисков с просмотром вперёд всех игр и догоняющих шагов этого кадра
+            search_deadline = time.perf_counter() + SEARCH_BUDGET_SHARE / FPS
+            repaint = lut_version != brightness_lut.version
+            lut_version = brightness_lut.version
+            rgb = brightness_lut.rgb
+            pixels = 0
+            for panel in panels:
+                framebuffer, rows = panel.framebuffer, panel.rows
+                changed = []
+                for game in panel.games:
+                    for _ in range(steps):
+                        game.update(search_deadline)
+                    for r, c, index in game.pop_changes():
+                        c += game.cols_start
+                        if framebuffer.set(r, c, index) and (index == 0 or not repaint):
+                            # Поворот: колонка матрицы — строка устройства
+                            changed.append((c + 1, rows - r, rgb[index]))
+                if repaint:
+                    # Яркость сменилась — одна перерисовка всех горящих светодиодов
+                    changed.extend((c + 1, rows - r, rgb[index]) for r, c, index in framebuffer.lit())
                 if changed:
-                    print(f"📦 {task_name}: Отправка {len(changed)} изменённых пикселей")
-                    cmds = build_command_from_pixels(changed)
-                    if cmds:
-                        print(f"📦 {task_name}: Сформировано {len(cmds)} команд")
-                        await send_commands(ble_manager, cmds)
-            except Exception as e:
-                print(f"⚠️ {task_name}: Ошибка при отправке данных: {e}")
-                await ble_manager.disconnect()  # Принудительно отключаем для переподключения
-                await asyncio.sleep(2)
+                    panel.coalescer.post(changed)
+                pixels += len(changed)
+            FRAME_PIXELS.observe(pixels)
+            FRAME_COMPUTE_SECONDS.observe(loop.time() - scheduler.frame_start)
 
-            await asyncio.sleep(1 / FPS)
+            if time.monotonic() - last_report >= FRAME_STATS_INTERVAL:
+                last_report = time.monotonic()
+                print(f"⏱️ {task_name}: {scheduler.summary()}")
+            await scheduler.end_frame()
     except asyncio.CancelledError:
         print(f"🛑 {task_name}: Задача отменена")
         return
     except Exception as e:
         print(f"❌ {task_name}: Ошибка в задаче: {e}")
         return
+    finally:
+        await asyncio.gather(*(panel.coalescer.stop() for panel in panels))
+
+
+async def replay_loop(curtain, path):
+    """Send this curtain's recorded batches from the memory-mapped file, one per frame at FPS."""
+    task_name = f"Replay_{curtain.config.address}"
+    global frame_scheduler
+    scheduler = frame_scheduler = FrameScheduler()
+    batches = 0
+    try:
+        with open(path, 'rb') as data_file, open(path + '.idx', 'rb') as index_file, \
+                mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as index:
+            # Недописанная последняя запись индекса (обрыв при записи) пропускается
+            end_of_index = len(index) - RECORDING_ENTRY.size
+            cursor = 0
+            finished = False
+            while not finished:
+                steps = scheduler.start_frame()
+                cmds = []
+                while steps and cursor <= end_of_index:
+                    offset, length, channel = RECORDING_ENTRY.unpack_from(index, cursor)
+                    cursor += RECORDING_ENTRY.size
+                    if channel != curtain.channel:
+                        continue
+                    steps -= 1
+                    batch = memoryview(data[offset:offset + length])
+                    pos = 0
+                    while pos < length:
+                        end = pos + 1 + batch[pos]
+                        cmds.append(batch[pos + 1:end])
+                        pos = end
+                    batches += 1
+                finished = cursor > end_of_index
+                if cmds:
+                    for attempt in range(3):
+                        try:
+                            await (await curtain.ble_manager.submit(cmds))
+                            break
+                        except Exception:
+                            if attempt == 2:
+                                raise
+                            BLE_RETRIES.inc()
+                FRAME_COMPUTE_SECONDS.observe(scheduler.loop.time() - scheduler.frame_start)
+                if not finished:
+                    await scheduler.end_frame()
+        print(f"⏹️ {task_name}: Повтор завершён, кадров {batches}; {scheduler.summary()}")
+    except asyncio.CancelledError:
+        print(f"🛑 {task_name}: Задача отменена после {batches} кадров")
+    except Exception as e:
+        print(f"❌ {task_name}: Ошибка в задаче: {e}")
+    finally:
+        # Что показывает штора, coalescer не знает — перед следующим кадром её нужно подготовить заново
+        curtain.per_led = False
 # -----------------------
 
 
+async def prepare_curtains(curtains):
+    """Prepare all curtains concurrently; returns (ready curtains, error strings for the rest)."""
+    results = await asyncio.gather(*(curtain.prepare() for curtain in curtains), return_exceptions=True)
+    failed = [f"{cu.config.address}: {e!r}" for cu, e in zip(curtains, results) if isinstance(e, Exception)]
+    ready = [cu for cu, e in zip(curtains, results) if not isinstance(e, Exception)]
+    return ready, failed
+
+
+def stop_recording():
+    global recorder
+    if recorder is not None:
+        recorder.close()
+        print(f"⏹️ Запись {recorder.path} остановлена, пачек {recorder.batches}")
+        recorder = None
+
+
+async def stop_games():
+    if any(not t.done() for t in game_tasks):
+        for t in game_tasks:
+            t.cancel()
+        await asyncio.gather(*game_tasks, return_exceptions=True)
+        game_tasks.clear()
+
+
 async def handle_mode(request):
-    global FPS, ALPHA, BETA, GAMMA, BRIGHTNESS
+    global FPS, ALPHA, BETA, GAMMA, TARGET_HEIGHT, LOOKAHEAD_DEPTH, recorder
     cmd = request.rel_url.query.get("cmd")
     if cmd is None:
         return web.Response(text="Параметр cmd обязателен", status=400)
     cmd = cmd.strip()
     print(f"HTTP: получена команда: {cmd}")
 
-    ble_manager = request.app['ble_manager']
+    curtains = request.app['curtains']
     global game_tasks
 
     if cmd == "Тетрис":
         if any(not t.done() for t in game_tasks):
             return web.Response(text="Игра уже запущена")
-        try:
-            await ble_manager.get_client()
-            await enter_per_led_mode(ble_manager)
-        except Exception as e:
-            return web.Response(status=500, text=f"Ошибка BLE при инициализации: {e}")
-        task1 = asyncio.create_task(single_game_loop(ble_manager, 0, HALF_COLS))
-        task2 = asyncio.create_task(single_game_loop(ble_manager, HALF_COLS, HALF_COLS))
+        # Шторы готовятся параллельно; недоступная не мешает запустить остальные
+        ready, failed = await prepare_curtains(curtains)
+        if not ready:
+            return web.Response(status=500, text=f"Ошибка BLE при инициализации: {'; '.join(failed)}")
+        seed_base = int(time.time() * 1000)
+        panels, offset = [], 0
+        for curtain in ready:
+            panels.append(Panel(curtain, seed_base + offset))
+            offset += curtain.config.cols
+        task = asyncio.create_task(compositor_loop(panels))
         game_tasks.clear()
-        game_tasks.extend([task1, task2])
-        return web.Response(text="Две игры Тетрис запущены")
+        game_tasks.append(task)
+        text = f"Игры Тетрис запущены: {sum(len(p.games) for p in panels)} на {len(panels)} из {len(curtains)} штор"
+        if failed:
+            text += f"; ошибки BLE: {'; '.join(failed)}"
+        return web.Response(text=text)
 
     elif cmd == "Стоп":
         if not any(not t.done() for t in game_tasks):
@@ -433,6 +1873,46 @@ async def handle_mode(request):
         game_tasks.clear()
         return web.Response(text="Все игры остановлены")
 
+    elif cmd == "Запись":
+        if recorder is None:
+            return web.Response(text="Запись не ведётся")
+        path, batches = recorder.path, recorder.batches
+        stop_recording()
+        return web.Response(text=f"Запись {path} остановлена, пачек {batches}")
+
+    elif cmd.startswith("Запись:"):
+        try:
+            path = recording_path(cmd.split(":", 1)[1].strip())
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
+        os.makedirs(RECORDINGS_DIR, exist_ok=True)
+        stop_recording()
+        recorder = Recorder(path)
+        # Опорный кадр: повтор начинается с пустой шторы, а уже горящие светодиоды могут больше не меняться
+        for curtain in curtains:
+            recorder.record(curtain.channel, curtain.coalescer.keyframe())
+        return web.Response(text=f"Запись в {path}")
+
+    elif cmd.startswith("Повтор:"):
+        try:
+            path = recording_path(cmd.split(":", 1)[1].strip())
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
+        if recorder is not None and recorder.path == path:
+            return web.Response(text="Эта запись ещё ведётся", status=400)
+        if not os.path.exists(path) or not os.path.exists(path + '.idx') or \
+                os.path.getsize(path + '.idx') < RECORDING_ENTRY.size:
+            return web.Response(text=f"Запись {path} не найдена или пуста", status=404)
+        await stop_games()
+        ready, failed = await prepare_curtains(curtains)
+        if not ready:
+            return web.Response(status=500, text=f"Ошибка BLE при инициализации: {'; '.join(failed)}")
+        game_tasks.extend(asyncio.create_task(replay_loop(curtain, path)) for curtain in ready)
+        text = f"Повтор {path} запущен на {len(ready)} из {len(curtains)} штор"
+        if failed:
+            text += f"; ошибки BLE: {'; '.join(failed)}"
+        return web.Response(text=text)
+
     elif cmd.startswith("FPS:"):
         try:
             new_fps = float(cmd.split(":")[1])
@@ -447,22 +1927,58 @@ async def handle_mode(request):
     elif cmd.startswith("Вес:"):
         try:
             weights = cmd.split(":")[1].split(",")
-            if len(weights) != 3:
-                return web.Response(text="Необходимо указать три веса (ALPHA,BETA,GAMMA)", status=400)
-            new_alpha, new_beta, new_gamma = map(float, weights)
-            if all(w >= 0 for w in [new_alpha, new_beta, new_gamma]):
-                ALPHA, BETA, GAMMA = new_alpha, new_beta, new_gamma
-                return web.Response(text=f"Веса установлены: ALPHA={new_alpha}, BETA={new_beta}, GAMMA={new_gamma}")
-            else:
+            if len(weights) not in (3, 4):
+                return web.Response(text="Необходимо указать три веса (ALPHA,BETA,GAMMA) и, по желанию, TARGET_HEIGHT",
+                                    status=400)
+            new_alpha, new_beta, new_gamma = map(float, weights[:3])
+            new_target = float(weights[3]) if len(weights) == 4 else TARGET_HEIGHT
+            if not all(w >= 0 for w in [new_alpha, new_beta, new_gamma]):
                 return web.Response(text="Веса должны быть неотрицательными", status=400)
+            if not 0 <= new_target <= ROWS:
+                return web.Response(text=f"TARGET_HEIGHT должна быть от 0 до {ROWS}", status=400)
+            ALPHA, BETA, GAMMA, TARGET_HEIGHT = new_alpha, new_beta, new_gamma, new_target
+            placement_cache.clear()
+            return web.Response(text=f"Веса установлены: ALPHA={new_alpha}, BETA={new_beta}, GAMMA={new_gamma}, "
+                                     f"TARGET_HEIGHT={new_target}")
         except (IndexError, ValueError):
             return web.Response(text="Неверный формат команды Вес", status=400)
 
+    elif cmd.startswith("Глубина:"):
+        try:
+            new_depth = int(cmd.split(":")[1])
+            if 0 <= new_depth <= 4:
+                LOOKAHEAD_DEPTH = new_depth
+                return web.Response(text=f"Глубина просмотра установлена на {new_depth}")
+            else:
+                return web.Response(text="Глубина должна быть от 0 до 4", status=400)
+        except (IndexError, ValueError):
+            return web.Response(text="Неверный формат команды Глубина", status=400)
+
+    elif cmd == "Кадры":
+        if frame_scheduler is None:
+            return web.Response(text="Игра ещё не запускалась")
+        return web.Response(text=frame_scheduler.summary())
+
+    elif cmd == "Кэш":
+        st = placement_cache.stats()
+        return web.Response(text=f"Кэш размещений: {st['size']}/{st['maxsize']}, попаданий {st['hits']}, промахов {st['misses']} ({st['hit_rate']:.1%})")
+
+    elif cmd.startswith("Кэш:"):
+        try:
+            new_size = int(cmd.split(":")[1])
+            if new_size >= 0:
+                placement_cache.resize(new_size)
+                return web.Response(text=f"Размер кэша установлен на {new_size}")
+            else:
+                return web.Response(text="Размер кэша должен быть неотрицательным", status=400)
+        except (IndexError, ValueError):
+            return web.Response(text="Неверный формат команды Кэш", status=400)
+
     elif cmd.startswith("Яркость:"):
         try:
             new_brightness = float(cmd.split(":")[1])
             if 0.0 <= new_brightness <= 1.0:
-                BRIGHTNESS = new_brightness
+                brightness_lut.rebuild(new_brightness)
                 return web.Response(text=f"Яркость установлена на {new_brightness}")
             else:
                 return web.Response(text="Яркость должна быть от 0.0 до 1.0", status=400)
@@ -470,58 +1986,160 @@ async def handle_mode(request):
             return web.Response(text="Неверный формат команды Яркость", status=400)
 
     elif cmd in CMD_MAP:
-        if any(not t.done() for t in game_tasks):
-            for t in game_tasks:
-                t.cancel()
-            await asyncio.gather(*game_tasks, return_exceptions=True)
-            game_tasks.clear()
-        try:
-            await send_control_command(ble_manager, CMD_MAP[cmd])
-            return web.Response(text=f"Команда {cmd} отправлена")
-        except Exception as e:
-            return web.Response(status=500, text=f"Ошибка BLE: {e}")
+        await stop_games()
+        for curtain in curtains:
+            curtain.per_led = False
+        results = await asyncio.gather(*(send_control_command(curtain.ble_manager, CMD_MAP[cmd])
+                                         for curtain in curtains), return_exceptions=True)
+        failed = [f"{cu.config.address}: {e!r}" for cu, e in zip(curtains, results) if isinstance(e, Exception)]
+        if failed:
+            return web.Response(status=500, text=f"Ошибка BLE: {'; '.join(failed)}")
+        return web.Response(text=f"Команда {cmd} отправлена")
     else:
         return web.Response(text=f"Неизвестная команда: {cmd}", status=400)
 
 
 
 
-async def start_app(ble_manager):
+# --- /ws: двоичные кадры, первый байт — тип, второй — номер шторы
+WS_FULL = 0x01      # 01 штора строки колонки + строки*колонки*3 RGB, по строкам от левого верхнего угла
+WS_DELTA = 0x02     # 02 штора + (строка, колонка, R, G, B) * n
+WS_SNAPSHOT = 0x03  # 03 штора — ответ WS_FULL с текущим кадром
+WS_PREVIEW = 0x04   # 04 штора 0|1 — присылать WS_FULL каждый кадр, пока он меняется
+
+
+async def handle_ws(request):
+    """Stream frames to the curtains through their coalescers and send previews back."""
+    curtains = request.app['curtains']
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    previews = set()
+
+    def full_frame(index):
+        cfg = curtains[index].config
+        return bytes((WS_FULL, index, cfg.rows, cfg.cols)) + curtains[index].snapshot()
+
+    async def stream_previews():
+        sent = {}
+        while True:
+            for index in list(previews):
+                frame = full_frame(index)
+                if sent.get(index) != frame:
+                    await ws.send_bytes(frame)
+                    sent[index] = frame
+            await asyncio.sleep(1 / FPS)
+
+    streamer = asyncio.create_task(stream_previews())
+    try:
+        async for msg in ws:
+            if msg.type != web.WSMsgType.BINARY:
+                continue
+            data = msg.data
+            if len(data) < 2 or data[1] >= len(curtains):
+                WS_FRAMES['invalid'].inc()
+                await ws.send_str("Неверный заголовок кадра")
+                continue
+            kind, index = data[0], data[1]
+            curtain = curtains[index]
+            rows, cols = curtain.config.rows, curtain.config.cols
+            if kind == WS_SNAPSHOT:
+                await ws.send_bytes(full_frame(index))
+            elif kind == WS_PREVIEW:
+                if len(data) > 2 and data[2]:
+                    previews.add(index)
+                else:
+                    previews.discard(index)
+            elif kind == WS_FULL and data[2:4] == bytes((rows, cols)) and len(data) == 4 + rows * cols * 3:
+                if await take_over(curtain, ws):
+                    WS_FRAMES['full'].inc()
+                    curtain.post_frame(data[4:])
+            elif kind == WS_DELTA and (len(data) - 2) % PIXEL_SIZE == 0:
+                deltas = list(struct.iter_unpack("5B", data[2:]))
+                if any(r >= rows or c >= cols for r, c, *_ in deltas):
+                    WS_FRAMES['invalid'].inc()
+                    await ws.send_str(f"Пиксель вне панели {rows}x{cols}")
+                elif await take_over(curtain, ws):
+                    WS_FRAMES['delta'].inc()
+                    curtain.post_delta(deltas)
+            else:
+                WS_FRAMES['invalid'].inc()
+                await ws.send_str(f"Неверный кадр типа {kind} для панели {rows}x{cols}")
+    finally:
+        streamer.cancel()
+        await asyncio.gather(streamer, return_exceptions=True)
+    return ws
+
+
+async def take_over(curtain, ws):
+    """Stop the games and put the curtain into per-LED mode before the first streamed frame."""
+    await stop_games()
+    if curtain.per_led:
+        return True
+    try:
+        await curtain.prepare()
+        return True
+    except Exception as e:
+        await ws.send_str(f"Ошибка BLE при инициализации: {e!r}")
+        return False
+
+
+async def handle_metrics(request):
+    return web.Response(text=render_metrics(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+def make_app(ble_pool, layout):
     app = web.Application()
-    app['ble_manager'] = ble_manager
+    app['ble_pool'] = ble_pool
+    app['curtains'] = [Curtain(cfg, ble_pool.get(cfg.address), i) for i, cfg in enumerate(layout)]
 
     async def on_shutdown(app):
-        await ble_manager.disconnect()
+        await ble_pool.stop()
 
     app.on_shutdown.append(on_shutdown)
-    app.add_routes([web.get('/mode', handle_mode)])
+    app.add_routes([web.get('/mode', handle_mode), web.get('/metrics', handle_metrics), web.get('/ws', handle_ws)])
+    return app
+
+
+async def start_app(ble_pool, layout):
+    app = make_app(ble_pool, layout)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', 8080)
     await site.start()
     print("🚀 HTTP сервер запущен на http://0.0.0.0:8080")
 
-async def shutdown(loop, ble_manager):
+async def shutdown(loop, ble_pool):
     for t in game_tasks:
         t.cancel()
     await asyncio.gather(*game_tasks, return_exceptions=True)
-    await ble_manager.disconnect()
+    stop_speculation_pool()
+    stop_recording()
+    await ble_pool.stop()
     loop.stop()
 
 async def main():
     loop = asyncio.get_running_loop()
-    ble_manager = BLEManager(DEVICE_ADDRESS)
+    layout = load_layout()
+    ble_pool = BLEPool()
     
     # Добавляем обработчик SIGTERM 
-    loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(shutdown(loop, ble_manager)))
+    loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(shutdown(loop, ble_pool)))
     
     
-    await start_app(ble_manager)
+    for cfg in layout:
+        ble_pool.get(cfg.address)
+        print(f"🪟 Штора {cfg.address}: {cfg.rows}x{cfg.cols}, игр {cfg.games}")
+    start_speculation_pool()
+    lag_monitor = asyncio.create_task(monitor_loop_lag())
+    await start_app(ble_pool, layout)
     
     try:
         await asyncio.Event().wait()
     finally:
-        await ble_manager.disconnect()
+        lag_monitor.cancel()
+        stop_speculation_pool()
+        stop_recording()
+        await ble_pool.stop()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,67 @@
+"""NumPy batch scoring against the pure-Python path: python3 -m unittest test_numpy_parity"""
+import unittest
+from unittest import mock
+
+import main
+
+SEEDS = range(8)
+WIDTHS = (4, 10, 17)
+UPDATES = 1000
+
+
+def play(seed, cols):
+    """Piece position and board after every update of one seeded game."""
+    main.placement_cache.clear()
+    game = main.TetrisGame(0, cols, seed=seed)
+    trace = []
+    for _ in range(UPDATES):
+        if game.game_over:
+            break
+        game.update()
+        trace.append((game.piece_blocks, game.piece_row, game.piece_col, tuple(game.field)))
+    return trace
+
+
+@unittest.skipIf(main.np is None, "NumPy не установлен")
+class NumpyParityTest(unittest.TestCase):
+    def setUp(self):
+        # Пакетная оценка для поисков любого размера, не только выше порога
+        for patcher in (mock.patch.object(main, 'NUMPY_MIN_CANDIDATES', 0),
+                        mock.patch.object(main, 'print', lambda *a, **k: None, create=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(main.placement_cache.clear)
+
+    def test_scores_and_picks_match_on_game_boards(self):
+        for cols in WIDTHS:
+            for seed in SEEDS:
+                game = main.TetrisGame(0, cols, seed=seed)
+                for step in range(UPDATES):
+                    if game.game_over:
+                        break
+                    if step % 11 == 0:
+                        for shapes in (main.TETROMINOS.values(), [game.piece_blocks]):
+                            candidates = game.candidate_placements(shapes, -2)
+                            if not candidates:
+                                continue
+                            expected = [game.evaluate(*c) for c in candidates]
+                            scores = main.batch_placement_scores(game, candidates)
+                            for want, got in zip(expected, scores):
+                                self.assertAlmostEqual(want, got, places=9)
+                            with mock.patch.object(main, 'USE_NUMPY', False):
+                                want = game.pick_placement(candidates)
+                            with mock.patch.object(main, 'USE_NUMPY', True):
+                                self.assertEqual(game.pick_placement(candidates), want, (cols, seed, step))
+                    game.update()
+
+    def test_seeded_games_play_the_same(self):
+        for cols in WIDTHS:
+            for seed in SEEDS:
+                with mock.patch.object(main, 'USE_NUMPY', False):
+                    expected = play(seed, cols)
+                with mock.patch.object(main, 'USE_NUMPY', True):
+                    self.assertEqual(play(seed, cols), expected, (cols, seed))
+
+
+if __name__ == '__main__':
+    unittest.main()
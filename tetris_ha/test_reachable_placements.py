@@ -0,0 +1,73 @@
+"""Shared-pass reachability against replaying the controller: python3 -m unittest test_reachable_placements"""
+import copy
+import random
+import unittest
+from unittest import mock
+
+import main
+
+SEEDS = range(8)
+WIDTHS = (4, 10, 17)
+UPDATES = 1500
+SAMPLE_RATE = 0.25
+
+
+def replay_lock(game, blocks, col):
+    """(rotation, column, row) where _step() locks the game's piece when steering it to (blocks, col)."""
+    # _step() только двигает фигуру копии, поле и цвета общие с игрой
+    game = copy.copy(game)
+    game.target_blocks, game.target_col = blocks, col
+    locked = []
+    game.lock_piece = lambda: locked.append((game.piece_blocks, game.piece_col, game.piece_row))
+    for _ in range(4 * game.rows * game.cols_count):
+        game._step()
+        if locked:
+            return locked[0]
+    raise AssertionError(f"фигура не зафиксировалась: {blocks}, {col}")
+
+
+class ReachablePlacementsTest(unittest.TestCase):
+    def setUp(self):
+        for patcher in (mock.patch.object(main, 'LOOKAHEAD_DEPTH', 0),
+                        mock.patch.object(main, 'print', lambda *a, **k: None, create=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        main.placement_cache.clear()
+        self.addCleanup(main.placement_cache.clear)
+
+    def test_matches_replayed_controller(self):
+        for cols in WIDTHS:
+            for seed in SEEDS:
+                game = main.TetrisGame(0, cols, seed=seed)
+                rng = random.Random(seed)
+                for step in range(UPDATES):
+                    if game.game_over:
+                        break
+                    if rng.random() < SAMPLE_RATE:
+                        expected = []
+                        for blocks, col in game.candidate_placements([game.piece_blocks], game.piece_row):
+                            b, c, r = replay_lock(game, blocks, col)
+                            if (b, c) == (blocks, col) and r <= main.landing_row(game.field, blocks, col):
+                                expected.append((blocks, col))
+                        got = main.reachable_placements(game.field, cols, game.piece_blocks,
+                                                        game.piece_row, game.piece_col)
+                        self.assertEqual(got, expected, (cols, seed, step))
+                    game.update()
+
+    def test_surface_tracking_matches_board(self):
+        for cols in WIDTHS:
+            for seed in SEEDS:
+                game = main.TetrisGame(0, cols, seed=seed)
+                locked = game.locked_pieces_count
+                for step in range(UPDATES):
+                    if game.game_over:
+                        break
+                    game.update()
+                    if game.locked_pieces_count != locked:
+                        locked = game.locked_pieces_count
+                        self.assertEqual(main.board_profile(game.field, cols), (game.heights, game.hole_count),
+                                         (cols, seed, step))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+"""Безголовый подбор весов ИИ: python3 tune.py [grid|random|evolve] ...
+
+Прогоняет тысячи игр TetrisGame по сидам без отрисовки и BLE в пуле
+процессов и ищет ALPHA, BETA, GAMMA и TARGET_HEIGHT с лучшей выживаемостью.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+from multiprocessing import Pool
+
+import main
+
+
+def init_worker():
+    main.print = lambda *a, **k: None
+
+
+def play(task):
+    """One seeded headless game with the given weights; returns its statistics.
+
+    TARGET_HEIGHT is in rows of a main.ROWS-high board, as at runtime; the
+    game scales it and HELP_THRESHOLD to its own height.
+    """
+    weights, seed, rows, cols, max_pieces = task
+    main.ALPHA, main.BETA, main.GAMMA, main.TARGET_HEIGHT = weights
+    # Кэш общий для всех партий процесса: без очистки время поиска зависело бы от сыгранных раньше
+    main.placement_cache.clear()
+    game = main.TetrisGame(0, cols, seed=seed, rows=rows)
+    while not game.game_over and game.locked_pieces_count < max_pieces:
+        game.update()
+    return weights, {
+        'pieces': game.locked_pieces_count,
+        'lines': game.lines_cleared,
+        'assists': game.assisted_spawns,
+        'search_seconds': game.search_seconds,
+        'survived': not game.game_over,
+    }
+
+
+def evaluate(pool, candidates, args):
+    """Play args.games seeds for every weight set; returns {weights: summary}."""
+    tasks = [(w, seed, args.rows, args.cols, args.max_pieces)
+             for w in candidates for seed in range(args.seed, args.seed + args.games)]
+    totals = {w: {'games': 0, 'pieces': 0, 'lines': 0, 'assists': 0, 'search_seconds': 0.0, 'survived': 0}
+              for w in candidates}
+    for weights, result in pool.imap_unordered(play, tasks, chunksize=max(1, len(tasks) // (64 * args.workers))):
+        t = totals[weights]
+        t['games'] += 1
+        for key, value in result.items():
+            t[key] += value
+    summary = {}
+    for weights, t in totals.items():
+        games = t['games']
+        summary[weights] = {
+            'alpha': weights[0], 'beta': weights[1], 'gamma': weights[2], 'target_height': weights[3],
+            'mean_pieces': t['pieces'] / games,
+            'mean_lines': t['lines'] / games,
+            'mean_assists': t['assists'] / games,
+            'survival_rate': t['survived'] / games,
+            'ai_ms_per_piece': t['search_seconds'] / max(1, t['pieces']) * 1000,
+        }
+    return summary, sum(t['games'] for t in totals.values()), sum(t['pieces'] for t in totals.values())
+
+
+def fitness(stats, objective):
+    if objective == 'lines':
+        return stats['mean_lines'], stats['mean_pieces']
+    return stats['mean_pieces'], stats['mean_lines']
+
+
+def random_weights(rng, args):
+    return (round(rng.uniform(*args.alpha_range), 3), round(rng.uniform(*args.beta_range), 3),
+            round(rng.uniform(*args.gamma_range), 3), round(rng.uniform(*args.target_range), 2))
+
+
+def mutate(rng, weights, args):
+    ranges = (args.alpha_range, args.beta_range, args.gamma_range, args.target_range)
+    out = []
+    for value, (lo, hi) in zip(weights, ranges):
+        value += rng.gauss(0, (hi - lo) * args.sigma)
+        out.append(round(min(hi, max(lo, value)), 3))
+    return tuple(out)
+
+
+def search(pool, args):
+    rng = random.Random(args.seed)
+    results = {}
+    games = pieces = 0
+
+    def run(candidates):
+        nonlocal games, pieces
+        fresh = [w for w in dict.fromkeys(candidates) if w not in results]
+        if fresh:
+            summary, g, p = evaluate(pool, fresh, args)
+            results.update(summary)
+            games += g
+            pieces += p
+
+    if args.strategy == 'grid':
+        run(list(itertools.product(args.alpha, args.beta, args.gamma, args.target)))
+    elif args.strategy == 'random':
+        run([random_weights(rng, args) for _ in range(args.samples)])
+    else:
+        population = [(main.ALPHA, main.BETA, main.GAMMA, main.TARGET_HEIGHT)]
+        population += [random_weights(rng, args) for _ in range(args.population - 1)]
+        for generation in range(args.generations):
+            run(population)
+            ranked = sorted(population, key=lambda w: fitness(results[w], args.objective), reverse=True)
+            elite = ranked[:max(1, args.population // 4)]
+            best = results[elite[0]]
+            print(f"поколение {generation + 1}: {elite[0]} → {best['mean_pieces']:.1f} фигур, "
+                  f"{best['mean_lines']:.1f} линий")
+            population = elite + [mutate(rng, rng.choice(elite), args)
+                                  for _ in range(args.population - len(elite))]
+    return results, games, pieces
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('strategy', choices=['grid', 'random', 'evolve'], nargs='?', default='evolve')
+    parser.add_argument('--games', type=int, default=64, help='сидов на набор весов')
+    parser.add_argument('--seed', type=int, default=0, help='первый сид')
+    parser.add_argument('--rows', type=int, default=main.ROWS)
+    parser.add_argument('--cols', type=int, default=main.HALF_COLS, help='колонок на игру')
+    parser.add_argument('--max-pieces', type=int, default=2000, help='предел длины игры')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--objective', choices=['survival', 'lines'], default='survival')
+    parser.add_argument('--out', default='tune_results.json')
+    # grid
+    parser.add_argument('--alpha', type=float, nargs='+', default=[0.5, 1.0, 2.0])
+    parser.add_argument('--beta', type=float, nargs='+', default=[2.5, 5.0, 10.0])
+    parser.add_argument('--gamma', type=float, nargs='+', default=[1.0, 2.0, 4.0])
+    parser.add_argument('--target', type=float, nargs='+', default=[main.TARGET_HEIGHT])
+    # random / evolve
+    parser.add_argument('--samples', type=int, default=32)
+    parser.add_argument('--population', type=int, default=12)
+    parser.add_argument('--generations', type=int, default=6)
+    parser.add_argument('--sigma', type=float, default=0.1, help='шаг мутации, доля диапазона')
+    parser.add_argument('--alpha-range', type=float, nargs=2, default=[0.0, 4.0])
+    parser.add_argument('--beta-range', type=float, nargs=2, default=[0.0, 20.0])
+    parser.add_argument('--gamma-range', type=float, nargs=2, default=[0.0, 8.0])
+    parser.add_argument('--target-range', type=float, nargs=2, default=[0.0, main.ROWS],
+                        help=f'TARGET_HEIGHT в строках стакана высотой {main.ROWS}')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with Pool(args.workers, initializer=init_worker) as pool:
+        results, games, pieces = search(pool, args)
+    elapsed = time.perf_counter() - started
+
+    ranked = sorted(results.values(), key=lambda st: fitness(st, args.objective), reverse=True)
+    best = ranked[0]
+    report = {
+        'strategy': args.strategy,
+        'objective': args.objective,
+        'board': {'rows': args.rows, 'cols': args.cols, 'max_pieces': args.max_pieces},
+        'best': best,
+        'command': f"Вес:{best['alpha']},{best['beta']},{best['gamma']},{best['target_height']}",
+        'throughput': {'games': games, 'seconds': elapsed, 'games_per_sec': games / elapsed,
+                       'pieces_per_sec': pieces / elapsed, 'workers': args.workers},
+        'results': ranked,
+    }
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps({k: report[k] for k in ('best', 'command', 'throughput')}, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main_cli()